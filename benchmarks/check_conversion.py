@@ -0,0 +1,190 @@
+"""Check the Pronto to Broadlink conversion against the reference one.
+
+The conversion functions of Helper were rewritten for speed. The original
+implementations are kept below as the reference, and their output is
+compared byte for byte with Helper.pronto2lirc, Helper.lirc2broadlink and
+Helper.convert_batch for:
+
+    every Pronto command of the device files under codes/
+    generated Pronto codes covering short and long pulses
+
+Invalid input must be rejected by both: odd length Pronto codes and pulses
+that don't fit in a Broadlink packet (above 0xffff or negative).
+
+Run from the repository root, in an environment with Home Assistant
+installed:
+
+    python benchmarks/check_conversion.py [--generated N] [--seed SEED]
+
+Exits with 1 if any output differs.
+"""
+import argparse
+from base64 import b64encode
+import binascii
+import glob
+import json
+import os
+import random
+import struct
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from custom_components.smartir import Helper  # noqa: E402
+from custom_components.smartir.controller import iter_commands  # noqa: E402
+
+
+def reference_pronto2lirc(pronto):
+    codes = [int(binascii.hexlify(pronto[i:i+2]), 16) for i in range(0, len(pronto), 2)]
+
+    if codes[0]:
+        raise ValueError("Pronto code should start with 0000")
+    if len(codes) != 4 + 2 * (codes[2] + codes[3]):
+        raise ValueError("Number of pulse widths does not match the preamble")
+
+    frequency = 1 / (codes[1] * 0.241246)
+    return [int(round(code / frequency)) for code in codes[4:]]
+
+
+def reference_lirc2broadlink(pulses):
+    array = bytearray()
+
+    for pulse in pulses:
+        pulse = int(pulse * 269 / 8192)
+
+        if pulse < 256:
+            array += bytearray(struct.pack('>B', pulse))
+        else:
+            array += bytearray([0x00])
+            array += bytearray(struct.pack('>H', pulse))
+
+    packet = bytearray([0x26, 0x00])
+    packet += bytearray(struct.pack('<H', len(array)))
+    packet += array
+    packet += bytearray([0x0d, 0x05])
+
+    # Add 0s to make ultimate packet size a multiple of 16 for 128-bit AES encryption.
+    remainder = (len(packet) + 4) % 16
+    if remainder:
+        packet += bytearray(16 - remainder)
+    return packet
+
+
+def reference_pronto2base64(command):
+    pronto = bytes.fromhex(command.replace(' ', ''))
+    return b64encode(reference_lirc2broadlink(
+        reference_pronto2lirc(pronto))).decode('utf-8')
+
+
+def library_prontos():
+    """Return the Pronto commands of the device files under codes/."""
+    commands = []
+
+    for path in sorted(glob.glob(os.path.join(ROOT_DIR, 'codes', '*', '*.json'))):
+        try:
+            with open(path, 'rb') as f:
+                device_data = json.load(f)
+        except ValueError:
+            continue
+        if device_data.get('commandsEncoding') == 'Pronto':
+            commands.extend(iter_commands(device_data['commands']))
+
+    return commands
+
+
+def generated_prontos(count, rng):
+    """Return random valid Pronto commands, with short and long pulses."""
+    commands = []
+
+    for _ in range(count):
+        frequency = rng.randint(0x60, 0x80)
+        once = rng.randint(0, 40)
+        repeat = rng.randint(0 if once else 1, 40)
+        pulses = [rng.choice((rng.randint(1, 0x40), rng.randint(0x40, 0x1000)))
+                  for _ in range(2 * (once + repeat))]
+        words = [0, frequency, once, repeat] + pulses
+        commands.append(' '.join('{:04X}'.format(word) for word in words))
+
+    return commands
+
+
+def check_equal(commands):
+    """Return the commands converted differently from the reference."""
+    mismatches = []
+
+    for command in commands:
+        pronto = bytes.fromhex(command.replace(' ', ''))
+        pulses = reference_pronto2lirc(pronto)
+
+        if (Helper.pronto2lirc(pronto) != pulses or
+                Helper.lirc2broadlink(pulses) != reference_lirc2broadlink(pulses)):
+            mismatches.append(command)
+
+    batch = Helper.convert_batch(commands, 'Pronto')
+    mismatches.extend(command for command, converted in zip(commands, batch)
+                      if converted != reference_pronto2base64(command))
+
+    return mismatches
+
+
+def _raises(func, *args):
+    try:
+        func(*args)
+    except (ValueError, struct.error):
+        return True
+    return False
+
+
+def check_errors():
+    """Return the invalid inputs not rejected by the reference and Helper."""
+    failures = []
+
+    odd_length = bytes.fromhex('0000006D00010000015B00AD00')
+    if not _raises(Helper.pronto2lirc, odd_length):
+        failures.append('pronto2lirc accepts an odd length code')
+    if not _raises(reference_pronto2lirc, odd_length):
+        failures.append('the reference pronto2lirc accepts an odd length code')
+
+    too_long = [(0xffff + 1) * 8192 / 269 + 1]
+    negative = [-1000]
+    for name, pulses in (('a pulse above 0xffff', too_long),
+                         ('a negative pulse', negative)):
+        if not _raises(Helper.lirc2broadlink, pulses):
+            failures.append('lirc2broadlink accepts {}'.format(name))
+        if not _raises(reference_lirc2broadlink, pulses):
+            failures.append('the reference lirc2broadlink accepts {}'.format(name))
+
+    return failures
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check the Pronto to Broadlink conversion.")
+    parser.add_argument('--generated', type=int, default=2000,
+                        help="number of generated Pronto codes")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the generated codes")
+    args = parser.parse_args(argv)
+
+    library = library_prontos()
+    generated = generated_prontos(args.generated, random.Random(args.seed))
+
+    mismatches = check_equal(library) + check_equal(generated)
+    failures = check_errors()
+
+    for command in mismatches:
+        print("Converted differently: {}".format(command), file=sys.stderr)
+    for failure in failures:
+        print(failure, file=sys.stderr)
+
+    print("{} library and {} generated Pronto codes, {} mismatches, "
+          "{} error case failures".format(len(library), len(generated),
+                                          len(mismatches), len(failures)),
+          file=sys.stderr)
+
+    return 1 if mismatches or failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,144 @@
+"""Check that compiled packs reproduce their device files.
+
+Every device file under codes/ is compiled to a pack in a temporary
+directory, and the pack is compared with the parsed JSON file:
+
+    info       the fields of the device file other than commands
+    freshness  the pack is fresh for the device file it was compiled from
+    keys       iterating a PackNode yields the keys of the JSON object, in
+               file order, and its length matches
+    leaves     every leaf is found, with the same value and type: strings,
+               and JSON values such as lists, numbers, null or {}
+    misses     looking up a key that doesn't exist raises KeyError
+
+Run from the repository root:
+
+    python benchmarks/check_packs.py [PATH ...]
+
+PATH defaults to codes/, device files that aren't valid JSON are skipped.
+Exits with 1 if any pack differs from its device file.
+"""
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'custom_components', 'smartir'))
+
+from codepack import CodePack, PackNode, compile_pack  # noqa: E402
+
+MISSING_KEY = '\x00missing'
+
+
+def compare_node(node, commands, path=()):
+    """Return the differences between a PackNode and a commands object."""
+    differences = []
+    where = '/'.join(path) or '<root>'
+
+    if list(node) != list(commands):
+        differences.append("{}: keys {} instead of {}".format(
+            where, list(node), list(commands)))
+    if len(node) != len(commands):
+        differences.append("{}: length {} instead of {}".format(
+            where, len(node), len(commands)))
+    if MISSING_KEY in node:
+        differences.append("{}: contains a missing key".format(where))
+
+    for key, expected in commands.items():
+        try:
+            value = node[key]
+        except KeyError:
+            differences.append("{}/{}: not found".format(where, key))
+            continue
+
+        if isinstance(expected, dict) and expected:
+            if not isinstance(value, PackNode):
+                differences.append("{}/{}: {!r} instead of an object".format(
+                    where, key, value))
+            else:
+                differences.extend(compare_node(value, expected, path + (key,)))
+        elif type(value) is not type(expected) or value != expected:
+            differences.append("{}/{}: {!r} instead of {!r}".format(
+                where, key, value, expected))
+
+    return differences
+
+
+def check_file(path, directory):
+    """Return the differences between a device file and its pack.
+
+    Return None if the device file isn't valid JSON.
+    """
+    try:
+        with open(path, 'rb') as f:
+            device_data = json.load(f)
+    except ValueError:
+        return None
+
+    dest = os.path.join(directory, '{}_{}.pack'.format(
+        os.path.basename(os.path.dirname(path)), os.path.basename(path)))
+    pack = CodePack(compile_pack(path, dest))
+
+    commands = device_data.pop('commands')
+    differences = []
+
+    if pack.info != device_data:
+        differences.append("info differs")
+    if not pack.is_fresh(os.stat(path)):
+        differences.append("the pack is not fresh")
+    if len(pack) != sum(1 for _ in _leaves(commands)):
+        differences.append("{} leaves instead of {}".format(
+            len(pack), sum(1 for _ in _leaves(commands))))
+
+    differences.extend(compare_node(pack.commands, commands))
+    return differences
+
+
+def _leaves(commands):
+    for value in commands.values():
+        if isinstance(value, dict) and value:
+            yield from _leaves(value)
+        else:
+            yield value
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Check that compiled packs reproduce their device files.")
+    parser.add_argument('paths', nargs='*', metavar='PATH',
+                        help="device file or directory (default: codes/)")
+    args = parser.parse_args(argv)
+
+    paths = []
+    for target in args.paths or [os.path.join(ROOT_DIR, 'codes')]:
+        if os.path.isdir(target):
+            paths.extend(sorted(glob.glob(
+                os.path.join(target, '**', '*.json'), recursive=True)))
+        else:
+            paths.append(target)
+
+    checked = skipped = failed = 0
+
+    with tempfile.TemporaryDirectory() as directory:
+        for path in paths:
+            differences = check_file(path, directory)
+            if differences is None:
+                skipped += 1
+                continue
+
+            checked += 1
+            failed += bool(differences)
+            for difference in differences:
+                print("{}: {}".format(path, difference), file=sys.stderr)
+
+    print("{} device files checked, {} skipped, {} packs differ".format(
+        checked, skipped, failed), file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,83 @@
+"""Minimal stand-in for the Home Assistant object used by the benchmarks.
+
+Only what the SmartIR controllers and entities touch is provided. Service
+calls are recorded (up to a limit) and return immediately, so the
+benchmarks measure SmartIR itself rather than a controller integration,
+unless a handler was registered for the service (e.g. by the simulator).
+Handlers are awaited, as if every call was blocking.
+"""
+import asyncio
+import types
+
+from homeassistant.const import (
+    EVENT_HOMEASSISTANT_CLOSE, EVENT_HOMEASSISTANT_STOP)
+
+MAX_RECORDED_CALLS = 1000
+
+
+class FakeServices:
+    """Records service calls, and runs the handlers registered for them."""
+
+    def __init__(self):
+        self.calls = []
+        self.count = 0
+        self._handlers = {}
+
+    async def async_call(self, domain, service, service_data=None,
+                         blocking=False, **kwargs):
+        self.count += 1
+        if len(self.calls) < MAX_RECORDED_CALLS:
+            self.calls.append((domain, service, service_data))
+
+        handler = self._handlers.get((domain, service))
+        if handler is not None:
+            await handler(types.SimpleNamespace(
+                domain=domain, service=service, data=service_data or {}))
+
+    def async_register(self, domain, service, handler, **kwargs):
+        self._handlers[(domain, service)] = handler
+
+    def has_service(self, domain, service):
+        return (domain, service) in self._handlers
+
+
+class FakeBus:
+    """Keeps the listeners of the events fired by FakeHass.async_stop."""
+
+    def __init__(self):
+        self._listeners = {}
+
+    def async_listen_once(self, event_type, listener):
+        listeners = self._listeners.setdefault(event_type, [])
+        listeners.append(listener)
+        return lambda: listener in listeners and listeners.remove(listener)
+
+    async def async_fire_once(self, event_type):
+        for listener in self._listeners.pop(event_type, []):
+            result = listener(types.SimpleNamespace(event_type=event_type))
+            if asyncio.iscoroutine(result):
+                await result
+
+
+class FakeHass:
+    """The attributes of HomeAssistant used by SmartIR."""
+
+    def __init__(self, config_dir='.'):
+        self.data = {}
+        self.services = FakeServices()
+        self.bus = FakeBus()
+        self.config = types.SimpleNamespace(
+            config_dir=config_dir,
+            units=types.SimpleNamespace(temperature_unit='°C'))
+        self.loop = asyncio.get_running_loop()
+
+    async def async_add_executor_job(self, target, *args):
+        return await self.loop.run_in_executor(None, target, *args)
+
+    def async_create_task(self, target, *args, **kwargs):
+        return self.loop.create_task(target)
+
+    async def async_stop(self):
+        """Fire the stop events, e.g. to close the HTTP sessions."""
+        await self.bus.async_fire_once(EVENT_HOMEASSISTANT_STOP)
+        await self.bus.async_fire_once(EVENT_HOMEASSISTANT_CLOSE)
@@ -0,0 +1,403 @@
+"""SmartIR benchmarks.
+
+Measures the device code library and the send hot path against a fake
+Home Assistant object, so results only depend on SmartIR itself:
+
+    codes        parse time and peak memory of every file under codes/
+    broadlink    BroadlinkController.send throughput per encoding
+    conversion   Helper.pronto2lirc / lirc2broadlink cost per pulse
+    entities     send latency of each entity type
+    load         throughput and pacing of every controller type against
+                 simulated hubs (see simulator.py)
+
+Run from the repository root, in an environment with Home Assistant
+installed:
+
+    python benchmarks/run.py [--quick] [--only SECTION ...] [--output FILE]
+                             [--frames FILE]
+
+Results are written as JSON (to stdout by default), a summary is printed
+to stderr. Compare two runs with e.g. `python -m json.tool`.
+"""
+import argparse
+import asyncio
+from base64 import b64decode
+import binascii
+import datetime
+import gc
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from benchmarks.fake_hass import FakeHass  # noqa: E402
+from benchmarks.simulator import HubSimulator  # noqa: E402
+from custom_components.smartir import VERSION, Helper  # noqa: E402
+from custom_components.smartir import (  # noqa: E402
+    climate, controller, fan, light, media_player, profiles)
+
+SECTIONS = ['codes', 'broadlink', 'conversion', 'entities', 'load']
+
+LARGEST_CLIMATE_FILES = 10
+
+BROADLINK_SAMPLES = {
+    'Base64': ('climate', 1000),
+    'Pronto': ('media_player', 9999),
+}
+
+ENTITY_DEVICES = {
+    'climate': (climate, 1000),
+    'fan': (fan, 1000),
+    'light': (light, 1000),
+    'media_player': (media_player, 1000),
+}
+
+# Controller: encoding, sample device file and controller_data of the hub
+LOAD_HUBS = {
+    controller.BROADLINK_CONTROLLER: ('Base64', ('climate', 1000), 'remote.bench_broadlink'),
+    controller.XIAOMI_CONTROLLER: ('Pronto', ('media_player', 9999), 'remote.bench_xiaomi'),
+    controller.MQTT_CONTROLLER: ('Raw', ('climate', 1406), 'bench/ir'),
+    controller.ESPHOME_CONTROLLER: ('Raw', ('climate', 7062), 'bench_send_raw'),
+    controller.LOOKIN_CONTROLLER: ('Pronto', ('media_player', 9999), None),
+}
+
+LOAD_DEVICES_PER_HUB = 4
+LOAD_AIRTIME = 0.01
+LOAD_JITTER = 0.002
+
+
+def _log(message, *args, **kwargs):
+    print(message.format(*args, **kwargs), file=sys.stderr)
+
+
+def _summary(durations):
+    """Return latency statistics in seconds."""
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'min': durations[0],
+        'median': statistics.median(durations),
+        'p95': durations[min(len(durations) - 1, int(len(durations) * 0.95))],
+        'mean': statistics.fmean(durations),
+    }
+
+
+def _measure(func, repeat):
+    """Return the best time and the peak memory of func()."""
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return best, peak
+
+
+def _load(platform_name, device_code):
+    with open(os.path.join(ROOT_DIR, 'codes', platform_name,
+                           '{}.json'.format(device_code)), 'rb') as f:
+        return json.load(f)
+
+
+def bench_codes(args):
+    """Parse time and peak memory of every device file."""
+    files = []
+    repeat = 1 if args.quick else 3
+
+    for path in sorted(glob.glob(os.path.join(ROOT_DIR, 'codes', '*', '*.json'))):
+        platform_name = os.path.basename(os.path.dirname(path))
+        result = {
+            'file': os.path.relpath(path, ROOT_DIR),
+            'platform': platform_name,
+            'size': os.path.getsize(path),
+        }
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        try:
+            result['parse_s'], result['parse_peak_bytes'] = _measure(
+                lambda: profiles._parse_json(content, profiles.PayloadTable()),
+                repeat)
+
+            if platform_name == 'climate':
+                result['lazy_s'], result['lazy_peak_bytes'] = _measure(
+                    lambda: profiles._scan_lazy(path, profiles.PayloadTable()),
+                    repeat)
+        except Exception as e:
+            result['error'] = str(e)
+
+        files.append(result)
+
+    parsed = [result for result in files if 'error' not in result]
+    largest = sorted((result for result in parsed if result['platform'] == 'climate'),
+                     key=lambda result: result['size'], reverse=True)
+
+    for result in largest[:LARGEST_CLIMATE_FILES]:
+        _log("  {file}: {size} bytes, parse {parse_s:.4f}s / {parse_peak_bytes} "
+             "bytes peak, lazy {lazy_s:.4f}s / {lazy_peak_bytes} bytes peak",
+             **result)
+
+    return {
+        'files': files,
+        'invalid': [result['file'] for result in files if 'error' in result],
+        'total_parse_s': sum(result['parse_s'] for result in parsed),
+        'largest_climate': [result['file']
+                            for result in largest[:LARGEST_CLIMATE_FILES]],
+    }
+
+
+def _broadlink_samples():
+    """Return sample commands for every encoding supported by Broadlink."""
+    samples = {}
+
+    for encoding, (platform_name, device_code) in BROADLINK_SAMPLES.items():
+        device_data = _load(platform_name, device_code)
+        samples[encoding] = list(controller.iter_commands(device_data['commands']))
+
+    # No device file uses Hex, derive it from the Base64 commands
+    samples['Hex'] = [binascii.hexlify(b64decode(command)).decode('ascii')
+                      for command in samples['Base64']]
+    return samples
+
+
+async def bench_broadlink(args):
+    """Throughput of BroadlinkController.send with cold and warm caches."""
+    hass = FakeHass()
+    sends = 200 if args.quick else 2000
+    results = {}
+
+    for encoding, commands in _broadlink_samples().items():
+        ctrl = controller.get_controller(
+            hass, controller.BROADLINK_CONTROLLER, encoding, 'remote.bench', 0)
+        cache = controller.BroadlinkController.command_cache
+        results[encoding] = {'commands': len(commands)}
+
+        for mode in ('cold', 'warm'):
+            cache.clear()
+            if mode == 'warm':
+                for command in commands:
+                    await ctrl.send(command)
+
+            start = time.perf_counter()
+            for index in range(sends):
+                if mode == 'cold':
+                    cache.clear()
+                await ctrl.send(commands[index % len(commands)])
+            elapsed = time.perf_counter() - start
+
+            results[encoding][mode + '_sends_per_s'] = sends / elapsed
+            _log("  {} {}: {:.0f} sends/s", encoding, mode, sends / elapsed)
+
+    return results
+
+
+def bench_conversion(args):
+    """Per pulse cost of the Pronto to Broadlink conversion steps."""
+    prontos = []
+    for path in sorted(glob.glob(os.path.join(ROOT_DIR, 'codes', '*', '*.json'))):
+        try:
+            with open(path, 'rb') as f:
+                device_data = json.load(f)
+        except ValueError:
+            continue
+        if device_data.get('commandsEncoding') == 'Pronto':
+            prontos.extend(bytes.fromhex(command.replace(' ', ''))
+                           for command in controller.iter_commands(
+                               device_data['commands']))
+
+    repeat = 1 if args.quick else 5
+    pulses = [Helper.pronto2lirc(pronto) for pronto in prontos]
+    count = sum(len(pulse) for pulse in pulses)
+
+    pronto2lirc_s, _ = _measure(
+        lambda: [Helper.pronto2lirc(pronto) for pronto in prontos], repeat)
+    lirc2broadlink_s, _ = _measure(
+        lambda: [Helper.lirc2broadlink(pulse) for pulse in pulses], repeat)
+
+    results = {
+        'commands': len(prontos),
+        'pulses': count,
+        'pronto2lirc_ns_per_pulse': pronto2lirc_s / count * 1e9,
+        'lirc2broadlink_ns_per_pulse': lirc2broadlink_s / count * 1e9,
+    }
+    _log("  {commands} commands, {pulses} pulses: pronto2lirc "
+         "{pronto2lirc_ns_per_pulse:.1f}ns, lirc2broadlink "
+         "{lirc2broadlink_ns_per_pulse:.1f}ns per pulse", **results)
+    return results
+
+
+async def _create_entity(hass, module, device_code):
+    config = module.PLATFORM_SCHEMA({
+        'platform': 'smartir',
+        'device_code': device_code,
+        'controller_data': 'remote.bench',
+        'delay': 0,
+    })
+    entities = []
+    await module.async_setup_platform(hass, config, entities.extend)
+    entity = entities[0]
+    entity.async_write_ha_state = lambda: None
+    return entity
+
+
+def _entity_actions(name, entity):
+    """Return two actions the entity alternates between."""
+    if name == 'climate':
+        entity._hvac_mode = entity.hvac_modes[1]
+        temperatures = [entity.min_temp, entity.min_temp + 1]
+        return [lambda t=t: entity.async_set_temperature(temperature=t)
+                for t in temperatures]
+    if name == 'fan':
+        return [lambda: entity.async_set_percentage(100),
+                lambda: entity.async_set_percentage(1)]
+    if name == 'light':
+        return [entity.async_turn_on, entity.async_turn_off]
+    return [entity.async_volume_up, entity.async_volume_down]
+
+
+async def bench_entities(args):
+    """Latency of the entity service methods down to the controller."""
+    profiles.COMPONENT_ABS_DIR = ROOT_DIR
+    hass = FakeHass()
+    calls = 100 if args.quick else 1000
+    results = {}
+
+    for name, (module, device_code) in ENTITY_DEVICES.items():
+        entity = await _create_entity(hass, module, device_code)
+        actions = _entity_actions(name, entity)
+        durations = []
+
+        for index in range(calls):
+            start = time.perf_counter()
+            await actions[index % len(actions)]()
+            durations.append(time.perf_counter() - start)
+
+        results[name] = dict(_summary(durations), device_code=device_code)
+        _log("  {}: median {:.1f}us, p95 {:.1f}us", name,
+             results[name]['median'] * 1e6, results[name]['p95'] * 1e6)
+
+    return results
+
+
+async def bench_load(args):
+    """Throughput and pacing of every controller type on simulated hubs.
+
+    Several devices share each hub and send concurrently, the simulator
+    records when every frame is transmitted.
+    """
+    hass = FakeHass()
+    simulator = HubSimulator(hass, airtime=LOAD_AIRTIME, jitter=LOAD_JITTER,
+                             seed=0)
+    sends = 10 if args.quick else 50
+    results = {}
+
+    try:
+        for name, (encoding, (platform_name, device_code), controller_data) \
+                in LOAD_HUBS.items():
+            if controller_data is None:
+                controller_data = await simulator.async_start_lookin()
+            elif name == controller.ESPHOME_CONTROLLER:
+                simulator.register_esphome(controller_data)
+
+            commands = list(controller.iter_commands(
+                _load(platform_name, device_code)['commands']))
+            devices = [controller.get_controller(
+                hass, name, encoding, controller_data, 0)
+                for _ in range(LOAD_DEVICES_PER_HUB)]
+            durations = []
+
+            async def _send(device, offset):
+                for index in range(sends):
+                    start = time.perf_counter()
+                    await device.send(commands[(offset + index) % len(commands)])
+                    durations.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(_send(device, offset)
+                                   for offset, device in enumerate(devices)))
+            elapsed = time.perf_counter() - start
+
+            results[name] = dict(
+                simulator.summary()[controller_data],
+                send_latency=_summary(durations),
+                elapsed_s=elapsed)
+            _log("  {}: {:.1f} frames/s, median gap {:.1f}ms, {} overlaps, "
+                 "{} reordered", name, results[name]['frames_per_s'],
+                 results[name]['median_gap'] * 1000,
+                 results[name]['overlaps'], results[name]['reordered'])
+    finally:
+        await simulator.async_stop()
+        await hass.async_stop()
+
+    if args.frames:
+        simulator.write_frames(args.frames)
+
+    return results
+
+
+async def main(argv):
+    parser = argparse.ArgumentParser(description="Run the SmartIR benchmarks.")
+    parser.add_argument('--quick', action='store_true',
+                        help="fewer iterations, for a quick check")
+    parser.add_argument('--only', nargs='+', choices=SECTIONS, default=SECTIONS,
+                        help="sections to run")
+    parser.add_argument('--output', help="JSON results file (default: stdout)")
+    parser.add_argument('--frames',
+                        help="JSON lines file of the frames of the load section")
+    args = parser.parse_args(argv)
+
+    results = {
+        'meta': {
+            'smartir_version': VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'quick': args.quick,
+        }
+    }
+
+    benchmarks = {
+        'codes': bench_codes,
+        'broadlink': bench_broadlink,
+        'conversion': bench_conversion,
+        'entities': bench_entities,
+        'load': bench_load,
+    }
+
+    for section in args.only:
+        _log("{}:", section)
+        result = benchmarks[section](args)
+        if asyncio.iscoroutine(result):
+            result = await result
+        results[section] = result
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(sys.argv[1:])))
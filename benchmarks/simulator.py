@@ -0,0 +1,227 @@
+"""Simulated IR hubs, to load-test SmartIR without hardware.
+
+The simulator stands in for the controllers of controller.py:
+
+    Broadlink, Xiaomi  a remote.send_command service
+    MQTT               a mqtt.publish service
+    ESPHome            esphome.<name> services, see register_esphome()
+    LOOKin             a local HTTP server shaped like the LOOKin
+                       /commands/ir/<encoding>/<command> API
+
+The services are registered with hass.services.async_register, so the
+simulator works with a Home Assistant instance as well as with FakeHass.
+
+Every frame (a single IR command) takes `airtime` seconds, give or take
+`jitter`, on its hub. A hub transmits at most `concurrency` frames at once,
+others wait for their turn, and a frame fails with `failure_rate`
+probability. Service handlers return, and HTTP requests are answered,
+once all their frames are transmitted, so SmartIR's own pacing shows up in
+the timings of blocking calls (FakeHass waits for every call).
+
+Every frame is recorded with the time it was received, started and ended,
+so throughput, ordering and pacing can be checked afterwards, e.g. from
+the file written by write_frames().
+
+    hass = FakeHass()
+    simulator = HubSimulator(hass, airtime=0.05, jitter=0.01)
+    simulator.register_esphome('living_room_send_raw')
+    address = await simulator.async_start_lookin()
+    ...
+    print(simulator.summary())
+    await simulator.async_stop()
+    await hass.async_stop()
+"""
+import asyncio
+import json
+import random
+import statistics
+import time
+
+MAX_RECORDED_FRAMES = 100000
+
+
+class Frame:
+    """An IR frame received by a simulated hub."""
+
+    __slots__ = ('index', 'hub', 'controller', 'payload', 'received',
+                 'started', 'ended', 'success')
+
+    def __init__(self, index, hub, controller, payload):
+        self.index = index
+        self.hub = hub
+        self.controller = controller
+        self.payload = payload
+        self.received = time.monotonic()
+        self.started = None
+        self.ended = None
+        self.success = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class HubSimulator:
+    """Simulated IR hubs for all the SmartIR controllers."""
+
+    def __init__(self, hass, airtime=0.05, jitter=0.0, failure_rate=0.0,
+                 concurrency=1, seed=None):
+        self.airtime = airtime
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.concurrency = concurrency
+        self.frames = []
+        self.received = 0
+        self._hass = hass
+        self._random = random.Random(seed)
+        self._hubs = {}
+        self._runners = []
+
+        hass.services.async_register(
+            'remote', 'send_command', self._async_handle_remote)
+        hass.services.async_register(
+            'mqtt', 'publish', self._async_handle_mqtt)
+
+    def register_esphome(self, name):
+        """Register the esphome.<name> service of a simulated ESPHome hub."""
+        self._hass.services.async_register(
+            'esphome', name, self._async_handle_esphome)
+
+    def _hub_semaphore(self, hub):
+        semaphore = self._hubs.get(hub)
+        if semaphore is None:
+            semaphore = self._hubs[hub] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    async def _async_transmit(self, hub, controller, payload):
+        """Transmit a frame on a hub. Return False if it failed."""
+        frame = Frame(self.received, hub, controller, payload)
+        self.received += 1
+        if len(self.frames) < MAX_RECORDED_FRAMES:
+            self.frames.append(frame)
+
+        async with self._hub_semaphore(hub):
+            frame.started = time.monotonic()
+            airtime = self.airtime + self._random.uniform(-self.jitter, self.jitter)
+            await asyncio.sleep(max(airtime, 0))
+            frame.ended = time.monotonic()
+            frame.success = self._random.random() >= self.failure_rate
+
+        return frame.success
+
+    async def _async_transmit_all(self, hub, controller, payloads, delay=0):
+        """Transmit frames one after the other, delay seconds apart."""
+        for index, payload in enumerate(payloads):
+            if index and delay:
+                await asyncio.sleep(delay)
+            if not await self._async_transmit(hub, controller, payload):
+                raise Exception("Simulated transmission failure on {}".format(hub))
+
+    async def _async_handle_remote(self, call):
+        """Handle remote.send_command for the Broadlink and Xiaomi controllers."""
+        service_data = call.data
+        commands = service_data['command']
+        if not isinstance(commands, list):
+            commands = [commands]
+
+        controller = 'Xiaomi' if commands[0].startswith(
+            ('pronto:', 'raw:')) else 'Broadlink'
+        payloads = commands * service_data.get('num_repeats', 1)
+
+        await self._async_transmit_all(
+            service_data['entity_id'], controller, payloads,
+            float(service_data.get('delay_secs', 0)))
+
+    async def _async_handle_mqtt(self, call):
+        """Handle mqtt.publish. A JSON array payload is a batch of frames."""
+        service_data = call.data
+        payload = service_data['payload']
+
+        try:
+            payloads = json.loads(payload)
+        except ValueError:
+            payloads = None
+        if not (isinstance(payloads, list) and
+                all(isinstance(item, str) for item in payloads)):
+            payloads = [payload]
+
+        await self._async_transmit_all(service_data['topic'], 'MQTT', payloads)
+
+    async def _async_handle_esphome(self, call):
+        """Handle an esphome.<name> call with the timings of a frame."""
+        await self._async_transmit_all(
+            call.service, 'ESPHome', [call.data['command']])
+
+    async def async_start_lookin(self, host='127.0.0.1', port=0):
+        """Start a simulated LOOKin hub. Return its address for controller_data."""
+        from aiohttp import web
+
+        async def _command(request):
+            success = await self._async_transmit(
+                address, 'LOOKin', '{}/{}'.format(
+                    request.match_info['encoding'], request.match_info['command']))
+            return web.Response(status=200 if success else 500)
+
+        app = web.Application()
+        app.router.add_get('/commands/ir/{encoding}/{command}', _command)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        self._runners.append(runner)
+
+        port = runner.addresses[0][1]
+        address = '{}:{}'.format(host, port)
+        return address
+
+    async def async_stop(self):
+        """Stop the simulated LOOKin hubs.
+
+        The HTTP sessions of the LOOKin controllers are closed by Home
+        Assistant when it stops, e.g. with FakeHass.async_stop().
+        """
+        for runner in self._runners:
+            await runner.cleanup()
+        self._runners.clear()
+
+    def summary(self):
+        """Return the throughput and pacing of every hub.
+
+        gap is the time between the end of a frame and the start of the
+        next one, overlaps the number of frames started before the previous
+        one ended, and reordered the number of frames started before a
+        frame received earlier.
+        """
+        hubs = {}
+        for frame in self.frames:
+            hubs.setdefault(frame.hub, []).append(frame)
+
+        summary = {}
+        for hub, frames in hubs.items():
+            done = sorted((frame for frame in frames if frame.ended is not None),
+                          key=lambda frame: frame.started)
+            gaps = [current.started - previous.ended
+                    for previous, current in zip(done, done[1:])]
+            span = done[-1].ended - done[0].started if done else 0
+
+            summary[hub] = {
+                'controller': frames[0].controller,
+                'frames': len(frames),
+                'failures': sum(1 for frame in done if not frame.success),
+                'frames_per_s': len(done) / span if span else None,
+                'min_gap': min(gaps) if gaps else None,
+                'median_gap': statistics.median(gaps) if gaps else None,
+                'overlaps': sum(1 for gap in gaps if gap < 0),
+                'reordered': sum(1 for previous, current in zip(done, done[1:])
+                                 if current.index < previous.index),
+                'max_wait': max(frame.started - frame.received for frame in done)
+                            if done else None,
+            }
+
+        return summary
+
+    def write_frames(self, path):
+        """Write the recorded frames as JSON lines."""
+        with open(path, 'w') as f:
+            for frame in self.frames:
+                f.write(json.dumps(frame.as_dict()) + '\n')
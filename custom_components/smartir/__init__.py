@@ -1,44 +1,95 @@
 import aiofiles
 import aiohttp
+from array import array
 import asyncio
+from base64 import b64encode
 import binascii
+from collections.abc import Mapping
 from distutils.version import StrictVersion
 import json
 import logging
 import os.path
 import requests
 import struct
+import sys
 import voluptuous as vol
 
 from aiohttp import ClientSession
 from homeassistant.const import (
-    ATTR_FRIENDLY_NAME, __version__ as current_ha_version)
+    ATTR_ENTITY_ID, ATTR_FRIENDLY_NAME, EVENT_HOMEASSISTANT_STARTED,
+    __version__ as current_ha_version)
+from homeassistant.config import config_per_platform
+from homeassistant.core import SupportsResponse, callback
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.storage import Store
 from homeassistant.helpers.typing import ConfigType
+from .broadcast import ACTIONS, async_broadcast
+from .profiling import MODE_CPROFILE, MODES, async_profile
 
 _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = 'smartir'
 VERSION = '1.18.0'
-MANIFEST_URL = (
+UPDATE_BASE_URL = (
     "https://raw.githubusercontent.com/"
-    "smartHomeHub/SmartIR/{}/"
-    "custom_components/smartir/manifest.json")
-REMOTE_BASE_URL = (
-    "https://raw.githubusercontent.com/"
-    "smartHomeHub/SmartIR/{}/"
-    "custom_components/smartir/")
+    "smartHomeHub/SmartIR/{}/")
+MANIFEST_PATH = "custom_components/smartir/manifest.json"
+COMPONENT_PATH = "custom_components/smartir/"
+UPDATE_CONCURRENCY = 4
+UPDATE_STORAGE_KEY = 'smartir.updater'
+UPDATE_STORAGE_VERSION = 1
 COMPONENT_ABS_DIR = os.path.dirname(
     os.path.abspath(__file__))
 
 CONF_CHECK_UPDATES = 'check_updates'
 CONF_UPDATE_BRANCH = 'update_branch'
+CONF_UPDATE_URL = 'update_url'
+CONF_TRANSMIT_SPACING = 'transmit_spacing'
+CONF_TRANSMIT_QUEUE_SIZE = 'transmit_queue_size'
+
+DEFAULT_TRANSMIT_SPACING = 0.0
+DEFAULT_TRANSMIT_QUEUE_SIZE = 32
+
+PLATFORMS = ['climate', 'fan', 'light', 'media_player']
+
+ENTITIES = 'entities'
+SERVICE_RESEND_STATE = 'resend_state'
+SERVICE_BROADCAST = 'broadcast'
+SERVICE_DIAGNOSTICS = 'diagnostics'
+SERVICE_MEMORY_REPORT = 'memory_report'
+SERVICE_PROFILE = 'profile'
+SERVICE_SETUP_REPORT = 'setup_report'
+ATTR_ACTION = 'action'
+ATTR_DURATION = 'duration'
+ATTR_MODE = 'mode'
+
+RESEND_STATE_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.entity_ids
+})
+
+BROADCAST_SCHEMA = vol.Schema({
+    vol.Required(ATTR_ENTITY_ID): cv.entity_ids,
+    vol.Required(ATTR_ACTION): vol.In(ACTIONS)
+})
+
+PROFILE_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_MODE, default=MODE_CPROFILE): vol.In(MODES),
+    vol.Optional(ATTR_DURATION, default=60): vol.All(
+        vol.Coerce(float), vol.Range(min=1, max=3600))
+})
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Optional(CONF_CHECK_UPDATES, default=True): cv.boolean,
         vol.Optional(CONF_UPDATE_BRANCH, default='master'): vol.In(
-            ['master', 'rc'])
+            ['master', 'rc']),
+        vol.Optional(CONF_UPDATE_URL, default=UPDATE_BASE_URL): cv.string,
+        vol.Optional(CONF_TRANSMIT_SPACING,
+                     default=DEFAULT_TRANSMIT_SPACING): cv.positive_float,
+        vol.Optional(CONF_TRANSMIT_QUEUE_SIZE,
+                     default=DEFAULT_TRANSMIT_QUEUE_SIZE): vol.All(
+            vol.Coerce(int), vol.Range(min=1))
     })
 }, extra=vol.ALLOW_EXTRA)
 
@@ -51,92 +102,249 @@ async def async_setup(hass, config):
 
     check_updates = conf[CONF_CHECK_UPDATES]
     update_branch = conf[CONF_UPDATE_BRANCH]
+    update_url = conf[CONF_UPDATE_URL]
+
+    hass.data.setdefault(DOMAIN, {}).update({
+        CONF_TRANSMIT_SPACING: conf[CONF_TRANSMIT_SPACING],
+        CONF_TRANSMIT_QUEUE_SIZE: conf[CONF_TRANSMIT_QUEUE_SIZE],
+    })
 
     async def _check_updates(service):
-        await _update(hass, update_branch)
+        await _update(hass, update_url, update_branch)
 
     async def _update_component(service):
-        await _update(hass, update_branch, True)
+        await _update(hass, update_url, update_branch, True)
+
+    async def _resend_state(service):
+        entities = hass.data[DOMAIN].get(ENTITIES, {})
+
+        for entity_id in service.data[ATTR_ENTITY_ID]:
+            entity = entities.get(entity_id)
+            if entity is None or not hasattr(entity, 'async_resend_state'):
+                _LOGGER.warning("%s cannot resend its state", entity_id)
+                continue
+            await entity.async_resend_state()
+
+    async def _broadcast(service):
+        entities = hass.data[DOMAIN].get(ENTITIES, {})
+        targets = []
+
+        for entity_id in service.data[ATTR_ENTITY_ID]:
+            if entity_id in entities:
+                targets.append(entities[entity_id])
+            else:
+                _LOGGER.warning("%s is not a SmartIR entity", entity_id)
+
+        return await async_broadcast(
+            targets, service.data[ATTR_ACTION], service.context)
+
+    async def _diagnostics(service):
+        from .diagnostics import async_get_diagnostics
+        return await async_get_diagnostics(hass)
+
+    async def _memory_report(service):
+        from .diagnostics import async_get_memory_report
+        return await async_get_memory_report(hass)
+
+    async def _setup_report(service):
+        from .tracing import get_setup_report
+        return get_setup_report(hass)
+
+    @callback
+    def _log_setup_report(event):
+        from .tracing import log_setup_report
+        log_setup_report(hass)
+
+    async def _profile(service):
+        return await async_profile(
+            hass, service.data[ATTR_MODE], service.data[ATTR_DURATION])
 
     hass.services.async_register(DOMAIN, 'check_updates', _check_updates)
     hass.services.async_register(DOMAIN, 'update_component', _update_component)
+    hass.services.async_register(
+        DOMAIN, SERVICE_RESEND_STATE, _resend_state, schema=RESEND_STATE_SCHEMA)
+    hass.services.async_register(
+        DOMAIN, SERVICE_BROADCAST, _broadcast, schema=BROADCAST_SCHEMA,
+        supports_response=SupportsResponse.OPTIONAL)
+    hass.services.async_register(
+        DOMAIN, SERVICE_DIAGNOSTICS, _diagnostics,
+        supports_response=SupportsResponse.ONLY)
+    hass.services.async_register(
+        DOMAIN, SERVICE_MEMORY_REPORT, _memory_report,
+        supports_response=SupportsResponse.ONLY)
+    hass.services.async_register(
+        DOMAIN, SERVICE_PROFILE, _profile, schema=PROFILE_SCHEMA,
+        supports_response=SupportsResponse.OPTIONAL)
+    hass.services.async_register(
+        DOMAIN, SERVICE_SETUP_REPORT, _setup_report,
+        supports_response=SupportsResponse.ONLY)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STARTED, _log_setup_report)
+
+    from .profiles import prefetch_device_files
+    prefetch_device_files(hass, _configured_devices(config))
 
     if check_updates:
-        await _update(hass, update_branch, False, False)
+        await _update(hass, update_url, update_branch, False, False)
 
     return True
 
-async def _update(hass, branch, do_update=False, notify_if_latest=True):
+def _configured_devices(config):
+    """Yield (platform, device_code) for every SmartIR device configured."""
+    for platform in PLATFORMS:
+        for p_type, p_config in config_per_platform(config, platform):
+            if p_type != DOMAIN:
+                continue
+            try:
+                yield platform, int(p_config['device_code'])
+            except (KeyError, TypeError, ValueError):
+                # Reported by the platform config validation
+                continue
+
+def register_entity(hass, entity):
+    """Make an entity reachable by the SmartIR services."""
+    hass.data.setdefault(DOMAIN, {}).setdefault(ENTITIES, {})[entity.entity_id] = entity
+
+def unregister_entity(hass, entity):
+    """Remove an entity registered with register_entity."""
+    hass.data.get(DOMAIN, {}).get(ENTITIES, {}).pop(entity.entity_id, None)
+
+async def _update(hass, base_url, branch, do_update=False, notify_if_latest=True):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(MANIFEST_URL.format(branch)) as response:
-                if response.status == 200:
-                    
-                    data = await response.json(content_type='text/plain')
-                    min_ha_version = data['homeassistant']
-                    last_version = data['updater']['version']
-                    release_notes = data['updater']['releaseNotes']
-
-                    if StrictVersion(last_version) <= StrictVersion(VERSION):
-                        if notify_if_latest:
-                            hass.components.persistent_notification.async_create(
-                                "You're already using the latest version!", 
-                                title='SmartIR')
-                        return
-
-                    if StrictVersion(current_ha_version) < StrictVersion(min_ha_version):
-                        hass.components.persistent_notification.async_create(
-                            "There is a new version of SmartIR integration, but it is **incompatible** "
-                            "with your system. Please first update Home Assistant.", title='SmartIR')
-                        return
+        session = async_get_clientsession(hass)
+        async with session.get((base_url + MANIFEST_PATH).format(branch)) as response:
+            if response.status == 200:
+                
+                data = await response.json(content_type='text/plain')
+                min_ha_version = data['homeassistant']
+                last_version = data['updater']['version']
+                release_notes = data['updater']['releaseNotes']
 
-                    if do_update is False:
-                        hass.components.persistent_notification.async_create(
-                            "A new version of SmartIR integration is available ({}). "
-                            "Call the ``smartir.update_component`` service to update "
-                            "the integration. \n\n **Release notes:** \n{}"
-                            .format(last_version, release_notes), title='SmartIR')
-                        return
-
-                    # Begin update
-                    files = data['updater']['files']
-                    has_errors = False
-
-                    for file in files:
-                        try:
-                            source = REMOTE_BASE_URL.format(branch) + file
-                            dest = os.path.join(COMPONENT_ABS_DIR, file)
-                            os.makedirs(os.path.dirname(dest), exist_ok=True)
-                            await Helper.downloader(source, dest)
-                        except Exception:
-                            has_errors = True
-                            _LOGGER.error("Error updating %s. Please update the file manually.", file)
-
-                    if has_errors:
+                if StrictVersion(last_version) <= StrictVersion(VERSION):
+                    if notify_if_latest:
                         hass.components.persistent_notification.async_create(
-                            "There was an error updating one or more files of SmartIR. "
-                            "Please check the logs for more information.", title='SmartIR')
-                    else:
-                        hass.components.persistent_notification.async_create(
-                            "Successfully updated to {}. Please restart Home Assistant."
-                            .format(last_version), title='SmartIR')
+                            "You're already using the latest version!", 
+                            title='SmartIR')
+                    return
+
+                if StrictVersion(current_ha_version) < StrictVersion(min_ha_version):
+                    hass.components.persistent_notification.async_create(
+                        "There is a new version of SmartIR integration, but it is **incompatible** "
+                        "with your system. Please first update Home Assistant.", title='SmartIR')
+                    return
+
+                if do_update is False:
+                    hass.components.persistent_notification.async_create(
+                        "A new version of SmartIR integration is available ({}). "
+                        "Call the ``smartir.update_component`` service to update "
+                        "the integration. \n\n **Release notes:** \n{}"
+                        .format(last_version, release_notes), title='SmartIR')
+                    return
+
+                # Begin update
+                files = data['updater']['files']
+                has_errors = not await _download_files(
+                    hass, session, (base_url + COMPONENT_PATH).format(branch), files)
+
+                if has_errors:
+                    hass.components.persistent_notification.async_create(
+                        "There was an error updating one or more files of SmartIR. "
+                        "Please check the logs for more information.", title='SmartIR')
+                else:
+                    hass.components.persistent_notification.async_create(
+                        "Successfully updated to {}. Please restart Home Assistant."
+                        .format(last_version), title='SmartIR')
     except Exception:
        _LOGGER.error("An error occurred while checking for updates.")
 
+async def _download_files(hass, session, remote_url, files):
+    """Download the files of the component, a few at a time.
+
+    The ETag/Last-Modified of the downloaded files are stored, so files
+    unchanged since the previous update are not downloaded again.
+    Return True if all the files are up to date.
+    """
+    store = Store(hass, UPDATE_STORAGE_VERSION, UPDATE_STORAGE_KEY)
+    validators = await store.async_load() or {}
+    semaphore = asyncio.Semaphore(UPDATE_CONCURRENCY)
+    unchanged = []
+
+    async def _download(file):
+        source = remote_url + file
+        dest = os.path.join(COMPONENT_ABS_DIR, file)
+
+        async with semaphore:
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                result = await Helper.downloader(
+                    source, dest, session, validators.get(source))
+            except Exception:
+                _LOGGER.error("Error updating %s. Please update the file manually.", file)
+                return False
+
+        if result is None:
+            unchanged.append(file)
+        else:
+            validators[source] = result
+        return True
+
+    results = await asyncio.gather(*(_download(file) for file in files))
+    await store.async_save(validators)
+
+    _LOGGER.debug("Updated %d files, %d were unchanged",
+                  len(files) - len(unchanged), len(unchanged))
+    return all(results)
+
 class Helper():
     @staticmethod
-    async def downloader(source, dest):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(source) as response:
-                if response.status == 200:
-                    async with aiofiles.open(dest, mode='wb') as f:
-                        await f.write(await response.read())
-                else:
-                    raise Exception("File not found")
+    async def downloader(source, dest, session=None, validators=None):
+        """Download source to dest.
+
+        validators are the ETag/Last-Modified returned with the copy at
+        dest. If the server reports it unchanged, dest is left untouched
+        and None is returned, otherwise the validators of the new copy.
+        """
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await Helper.downloader(source, dest, session, validators)
+
+        headers = {}
+        if validators and os.path.exists(dest):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        async with session.get(source, headers=headers) as response:
+            if response.status == 304:
+                return None
+            if response.status != 200:
+                raise Exception("File not found")
+
+            content = await response.read()
+            validators = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified')
+            }
+
+        # Never leave a partially written file behind
+        tmp_dest = dest + '.tmp'
+        try:
+            async with aiofiles.open(tmp_dest, mode='wb') as f:
+                await f.write(content)
+            os.replace(tmp_dest, dest)
+        except BaseException:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+            raise
+
+        return validators
 
     @staticmethod
     def pronto2lirc(pronto):
-        codes = [int(binascii.hexlify(pronto[i:i+2]), 16) for i in range(0, len(pronto), 2)]
+        codes = array('H')
+        codes.frombytes(pronto)
+        if sys.byteorder == 'little':
+            codes.byteswap()
 
         if codes[0]:
             raise ValueError("Pronto code should start with 0000")
@@ -144,28 +352,96 @@ class Helper():
             raise ValueError("Number of pulse widths does not match the preamble")
 
         frequency = 1 / (codes[1] * 0.241246)
-        return [int(round(code / frequency)) for code in codes[4:]]
+        return [int(round(code / frequency)) for code in memoryview(codes)[4:]]
 
     @staticmethod
     def lirc2broadlink(pulses):
-        array = bytearray()
+        # Every pulse takes 1 or 3 bytes, allocate the worst case once
+        # along with the header, the trailer and the padding.
+        packet = bytearray(4 + 3 * len(pulses) + 2 + 16)
+        packet[0] = 0x26
+        end = 4
 
         for pulse in pulses:
             pulse = int(pulse * 269 / 8192)
 
-            if pulse < 256:
-                array += bytearray(struct.pack('>B', pulse))
+            if 0 <= pulse < 256:
+                packet[end] = pulse
+                end += 1
+            elif 256 <= pulse <= 0xffff:
+                packet[end + 1] = pulse >> 8
+                packet[end + 2] = pulse & 0xff
+                end += 3
             else:
-                array += bytearray([0x00])
-                array += bytearray(struct.pack('>H', pulse))
+                raise ValueError("Pulse width {} is out of range".format(pulse))
 
-        packet = bytearray([0x26, 0x00])
-        packet += bytearray(struct.pack('<H', len(array)))
-        packet += array
-        packet += bytearray([0x0d, 0x05])
+        struct.pack_into('<H', packet, 2, end - 4)
+        packet[end:end + 2] = b'\x0d\x05'
+        end += 2
 
         # Add 0s to make ultimate packet size a multiple of 16 for 128-bit AES encryption.
-        remainder = (len(packet) + 4) % 16
+        remainder = (end + 4) % 16
         if remainder:
-            packet += bytearray(16 - remainder)
-        return packet
\ No newline at end of file
+            end += 16 - remainder
+        del packet[end:]
+        return packet
+
+    @staticmethod
+    def pronto2broadlink(pronto):
+        """Convert a Pronto hex string to a Broadlink packet."""
+        return Helper.lirc2broadlink(
+            Helper.pronto2lirc(bytes.fromhex(pronto.replace(' ', ''))))
+
+    @staticmethod
+    def hex2broadlink(command):
+        """Convert a Hex string to a Broadlink packet."""
+        return binascii.unhexlify(command)
+
+    @staticmethod
+    def base64_converter(encoding):
+        """Return a function converting a command to a Base64 Broadlink packet."""
+        if encoding == 'Pronto':
+            convert = Helper.pronto2broadlink
+        elif encoding == 'Hex':
+            convert = Helper.hex2broadlink
+        else:
+            raise ValueError("Unsupported encoding {}".format(encoding))
+
+        return lambda command: b64encode(convert(command)).decode('utf-8')
+
+    @staticmethod
+    def convert_batch(commands, encoding):
+        """Convert a list of Pronto or Hex commands to Base64 in one pass.
+
+        Identical commands are only converted once.
+        """
+        convert = Helper.base64_converter(encoding)
+        converted = {}
+
+        for command in commands:
+            if command not in converted:
+                converted[command] = convert(command)
+
+        return [converted[command] for command in commands]
+
+    @staticmethod
+    def convert_device_commands(commands, encoding):
+        """Convert every command of a device file commands tree to Base64.
+
+        Returns a tree of plain dicts and lists with the same shape.
+        """
+        convert = Helper.base64_converter(encoding)
+        converted = {}
+
+        def walk(value):
+            if isinstance(value, str):
+                if value not in converted:
+                    converted[value] = convert(value)
+                return converted[value]
+            if isinstance(value, list):
+                return [walk(item) for item in value]
+            if isinstance(value, Mapping):
+                return {key: walk(value[key]) for key in value}
+            return value
+
+        return walk(commands)
@@ -0,0 +1,90 @@
+"""Send the same action to many SmartIR devices at once."""
+import asyncio
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+ACTION_TURN_ON = 'turn_on'
+ACTION_TURN_OFF = 'turn_off'
+ACTION_RESEND_STATE = 'resend_state'
+
+ACTIONS = [ACTION_TURN_ON, ACTION_TURN_OFF, ACTION_RESEND_STATE]
+
+
+def group_by_hub(entities):
+    """Group entities by the hub their commands are transmitted through."""
+    hubs = {}
+    for entity in entities:
+        hubs.setdefault(entity._controller.hub, []).append(entity)
+    return hubs
+
+
+async def _async_run_action(entity, action, context):
+    start = time.monotonic()
+    result = {}
+
+    # Entities log the transmission errors rather than raising them, they
+    # are told by the error count of their send statistics
+    errors = entity._send_stats.errors
+
+    try:
+        if context is not None:
+            entity.async_set_context(context)
+        await getattr(entity, 'async_' + action)()
+
+        if entity._send_stats.errors > errors:
+            result['success'] = False
+            result['error'] = "The transmission failed, see the log for details"
+        else:
+            result['success'] = True
+    except Exception as e:
+        _LOGGER.error("Error while running %s on %s: %s",
+                      action, entity.entity_id, e)
+        result['success'] = False
+        result['error'] = str(e)
+
+    result['duration'] = round(time.monotonic() - start, 3)
+    return result
+
+
+async def _async_run_hub(hub, entities, action, context):
+    """Run the action on the entities of a hub, one after the other.
+
+    The hub scheduler paces the transmissions, so entities are not
+    started concurrently to keep them in the requested order.
+    """
+    results = {}
+
+    for entity in entities:
+        result = await _async_run_action(entity, action, context)
+        result['hub'] = ' '.join(str(part) for part in hub)
+        results[entity.entity_id] = result
+
+    return results
+
+
+async def async_broadcast(entities, action, context=None):
+    """Run an action on entities, concurrently across their hubs.
+
+    Return the success and duration of the action for each entity.
+    """
+    start = time.monotonic()
+    hubs = group_by_hub(entities)
+
+    hub_results = await asyncio.gather(*(
+        _async_run_hub(hub, hub_entities, action, context)
+        for hub, hub_entities in hubs.items()))
+
+    results = {}
+    for hub_result in hub_results:
+        results.update(hub_result)
+
+    _LOGGER.debug("Broadcast %s to %d devices on %d hubs in %.3fs",
+                  action, len(results), len(hubs), time.monotonic() - start)
+
+    return {
+        'duration': round(time.monotonic() - start, 3),
+        'hubs': len(hubs),
+        'results': results
+    }
@@ -1,8 +1,5 @@
 import asyncio
-import aiofiles
-import json
 import logging
-import os.path
 
 import voluptuous as vol
 
@@ -16,18 +13,27 @@ from homeassistant.core import callback
 from homeassistant.helpers.event import async_track_state_change
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreEntity
-from . import COMPONENT_ABS_DIR, Helper
-from .controller import get_controller
+from . import register_entity, unregister_entity
+from .controller import CONTROLLER_OPTIONS_SCHEMA, get_controller
+from .fingerprint import LastSentState, state_fingerprint
+from .profiles import PROFILE_CACHE, async_get_device_profile
+from .stats import SendStats, track_entity_send
+from .tracing import trace_setup, traced
 
 _LOGGER = logging.getLogger(__name__)
 
 DEFAULT_NAME = "SmartIR Climate"
 DEFAULT_DELAY = 0.5
+DEFAULT_DEBOUNCE = 0.0
+DEFAULT_RESEND_WINDOW = 0.0
 
 CONF_UNIQUE_ID = 'unique_id'
 CONF_DEVICE_CODE = 'device_code'
 CONF_CONTROLLER_DATA = "controller_data"
 CONF_DELAY = "delay"
+CONF_CONTROLLER_OPTIONS = 'controller_options'
+CONF_DEBOUNCE = 'debounce'
+CONF_RESEND_WINDOW = 'resend_window'
 CONF_TEMPERATURE_SENSOR = 'temperature_sensor'
 CONF_HUMIDITY_SENSOR = 'humidity_sensor'
 CONF_POWER_SENSOR = 'power_sensor'
@@ -46,6 +52,9 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_DEVICE_CODE): cv.positive_int,
     vol.Required(CONF_CONTROLLER_DATA): cv.string,
     vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.positive_float,
+    vol.Optional(CONF_CONTROLLER_OPTIONS, default={}): CONTROLLER_OPTIONS_SCHEMA,
+    vol.Optional(CONF_DEBOUNCE, default=DEFAULT_DEBOUNCE): cv.positive_float,
+    vol.Optional(CONF_RESEND_WINDOW, default=DEFAULT_RESEND_WINDOW): cv.positive_float,
     vol.Optional(CONF_TEMPERATURE_SENSOR): cv.entity_id,
     vol.Optional(CONF_HUMIDITY_SENSOR): cv.entity_id,
     vol.Optional(CONF_POWER_SENSOR): cv.entity_id,
@@ -56,55 +65,37 @@ async def async_setup_platform(hass, config, async_add_entities, discovery_info=
     """Set up the IR Climate platform."""
     _LOGGER.debug("Setting up the smartir platform")
     device_code = config.get(CONF_DEVICE_CODE)
-    device_files_subdir = os.path.join('codes', 'climate')
-    device_files_absdir = os.path.join(COMPONENT_ABS_DIR, device_files_subdir)
 
-    if not os.path.isdir(device_files_absdir):
-        os.makedirs(device_files_absdir)
+    with trace_setup(hass, 'climate', device_code, config.get(CONF_NAME)):
+        profile = await async_get_device_profile(
+            hass, 'climate', device_code, lazy=True)
 
-    device_json_filename = str(device_code) + '.json'
-    device_json_path = os.path.join(device_files_absdir, device_json_filename)
-
-    if not os.path.exists(device_json_path):
-        _LOGGER.warning("Couldn't find the device Json file. The component will " \
-                        "try to download it from the GitHub repo.")
-
-        try:
-            codes_source = ("https://raw.githubusercontent.com/"
-                            "smartHomeHub/SmartIR/master/"
-                            "codes/climate/{}.json")
-
-            await Helper.downloader(codes_source.format(device_code), device_json_path)
-        except Exception:
-            _LOGGER.error("There was an error while downloading the device Json file. " \
-                          "Please check your internet connection or if the device code " \
-                          "exists on GitHub. If the problem still exists please " \
-                          "place the file manually in the proper directory.")
+        if profile is None:
             return
 
-    try:
-        async with aiofiles.open(device_json_path, mode='r') as j:
-            _LOGGER.debug(f"loading json file {device_json_path}")
-            content = await j.read()
-            device_data = json.loads(content)
-            _LOGGER.debug(f"{device_json_path} file loaded")
-    except Exception:
-        _LOGGER.error("The device JSON file is invalid")
-        return
+        with traced('build'):
+            try:
+                entity = SmartIRClimate(hass, config, profile)
+            except Exception:
+                # The profile would never be evicted otherwise
+                PROFILE_CACHE.release(profile)
+                raise
 
-    async_add_entities([SmartIRClimate(
-        hass, config, device_data
-    )])
+            async_add_entities([entity])
 
 class SmartIRClimate(ClimateEntity, RestoreEntity):
-    def __init__(self, hass, config, device_data):
+    def __init__(self, hass, config, profile):
+        device_data = profile.data
         _LOGGER.debug(f"SmartIRClimate init started for device {config.get(CONF_NAME)} supported models {device_data['supportedModels']}")
         self.hass = hass
+        self._profile = profile
         self._unique_id = config.get(CONF_UNIQUE_ID)
         self._name = config.get(CONF_NAME)
         self._device_code = config.get(CONF_DEVICE_CODE)
         self._controller_data = config.get(CONF_CONTROLLER_DATA)
         self._delay = config.get(CONF_DELAY)
+        self._controller_options = config.get(CONF_CONTROLLER_OPTIONS)
+        self._debounce = config.get(CONF_DEBOUNCE)
         self._temperature_sensor = config.get(CONF_TEMPERATURE_SENSOR)
         self._humidity_sensor = config.get(CONF_HUMIDITY_SENSOR)
         self._power_sensor = config.get(CONF_POWER_SENSOR)
@@ -146,19 +137,29 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
             self._support_swing = True
 
         self._temp_lock = asyncio.Lock()
+        self._send_stats = SendStats()
         self._on_by_remote = False
 
+        #Latest-wins coalescing of state changes
+        self._send_generation = 0
+        self._saved_sends = 0
+        self._last_sent = LastSentState(config.get(CONF_RESEND_WINDOW))
+
         #Init the IR/RF controller
         self._controller = get_controller(
             self.hass,
             self._supported_controller,
             self._commands_encoding,
             self._controller_data,
-            self._delay)
+            self._delay,
+            self._controller_options)
             
     async def async_added_to_hass(self):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
+        register_entity(self.hass, self)
+        self.hass.async_create_task(
+            self._controller.async_prepare(self._commands))
         _LOGGER.debug(f"async_added_to_hass {self} {self.name} {self.supported_features}")
     
         last_state = await self.async_get_last_state()
@@ -172,6 +173,8 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
             if 'last_on_operation' in last_state.attributes:
                 self._last_on_operation = last_state.attributes['last_on_operation']
 
+            self._last_sent.restore(last_state.attributes)
+
         if self._temperature_sensor:
             async_track_state_change(self.hass, self._temperature_sensor, 
                                      self._async_temp_sensor_changed)
@@ -192,6 +195,13 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
             async_track_state_change(self.hass, self._power_sensor, 
                                      self._async_power_sensor_changed)
 
+    async def async_will_remove_from_hass(self):
+        """Release the shared device profile and the prepared commands."""
+        await super().async_will_remove_from_hass()
+        unregister_entity(self.hass, self)
+        self._controller.release()
+        PROFILE_CACHE.release(self._profile)
+
     @property
     def unique_id(self):
         """Return a unique ID."""
@@ -293,7 +303,8 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
             'manufacturer': self._manufacturer,
             'supported_models': self._supported_models,
             'supported_controller': self._supported_controller,
-            'commands_encoding': self._commands_encoding
+            'commands_encoding': self._commands_encoding,
+            **self._last_sent.attributes
         }
 
     async def async_set_temperature(self, **kwargs):
@@ -359,8 +370,35 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
         else:
             await self.async_set_hvac_mode(self._operation_modes[1])
 
-    async def send_command(self):
-        async with self._temp_lock:
+    def _is_superseded(self, generation):
+        """Return True if a newer state change will send the latest state."""
+        if generation == self._send_generation:
+            return False
+
+        self._saved_sends += 1
+        _LOGGER.debug("%s: skipped a superseded state change (%d saved)",
+                      self._name, self._saved_sends)
+        return True
+
+    async def async_resend_state(self):
+        """Send the current state, even if it was just sent."""
+        await self.send_command(force=True)
+        self.async_write_ha_state()
+
+    async def send_command(self, force=False):
+        self._send_generation += 1
+        generation = self._send_generation
+
+        if self._debounce:
+            await asyncio.sleep(self._debounce)
+
+            if self._is_superseded(generation):
+                return
+
+        async with track_entity_send(self._send_stats, self._temp_lock) as timer:
+            if self._is_superseded(generation):
+                return
+
             try:
                 self._on_by_remote = False
                 operation_mode = self._hvac_mode
@@ -369,22 +407,44 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
                 target_temperature = '{0:g}'.format(self._target_temperature)
 
                 if operation_mode.lower() == HVACMode.OFF:
-                    await self._controller.send(self._commands['off'])
+                    fingerprint = state_fingerprint(HVACMode.OFF)
+                else:
+                    fingerprint = state_fingerprint(
+                        operation_mode, fan_mode, swing_mode, target_temperature)
+
+                if not force and self._last_sent.is_redundant(fingerprint):
+                    _LOGGER.debug("%s: the state was just sent, skipping it",
+                                  self._name)
                     return
 
+                if operation_mode.lower() == HVACMode.OFF:
+                    await self._controller.send(
+                        self._commands['off'], context=self._context)
+                    self._last_sent.record(fingerprint)
+                    return
+
+                await self._profile.async_ensure_loaded(
+                    self.hass, operation_mode, fan_mode)
+
+                commands = []
+
                 if 'on' in self._commands:
-                    await self._controller.send(self._commands['on'])
-                    await asyncio.sleep(self._delay)
+                    commands.append(self._commands['on'])
 
                 if self._support_swing == True:
-                    await self._controller.send(
+                    commands.append(
                         self._commands[operation_mode][fan_mode][swing_mode][target_temperature])
                 else:
-                    await self._controller.send(
+                    commands.append(
                         self._commands[operation_mode][fan_mode][target_temperature])
 
+                await self._controller.send_sequence(
+                    commands, context=self._context)
+                self._last_sent.record(fingerprint)
+
             except Exception as e:
                 _LOGGER.exception(e)
+                timer.error = True
             
     async def _async_temp_sensor_changed(self, entity_id, old_state, new_state):
         """Handle temperature sensor changes."""
@@ -410,8 +470,11 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
         if old_state is not None and new_state.state == old_state.state:
             return
 
+        #The device was operated otherwise (e.g. by its own remote) if the
+        #sensor disagrees with the last state sent
         if new_state.state == STATE_ON and self._hvac_mode == HVACMode.OFF:
             self._on_by_remote = True
+            self._last_sent.invalidate()
             if self._power_sensor_restore_state == True and self._last_on_operation is not None:
                 self._hvac_mode = self._last_on_operation
             else:
@@ -423,6 +486,7 @@ class SmartIRClimate(ClimateEntity, RestoreEntity):
             self._on_by_remote = False
             if self._hvac_mode != HVACMode.OFF:
                 self._hvac_mode = HVACMode.OFF
+                self._last_sent.invalidate()
             self.async_write_ha_state()
 
     @callback
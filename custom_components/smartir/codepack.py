@@ -0,0 +1,287 @@
+"""Compiled binary packs of SmartIR device files.
+
+A pack holds the same data as a device JSON file in a form that can be
+memory-mapped and queried without parsing the whole file:
+
+    header     fixed size, see _HEADER
+    info       JSON object with every field of the device file but commands
+    entries    one fixed size _ENTRY per command leaf, in file order
+    order      entry indexes sorted by key, used for binary search
+    keys       UTF-8 command paths, components separated by KEY_SEPARATOR
+    payloads   UTF-8 payloads, identical payloads are stored once
+
+The header records the modification time and size of the source JSON file,
+so a pack is only used while it is up to date with it.
+
+Compile packs with:
+
+    python codepack.py <device file or directory> [...]
+"""
+from collections.abc import Mapping
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+
+PACK_EXTENSION = '.pack'
+KEY_SEPARATOR = '\x1f'
+_SEPARATOR = KEY_SEPARATOR.encode('utf-8')
+
+MAGIC = b'SIRP'
+FORMAT_VERSION = 1
+
+KIND_STRING = 0
+KIND_JSON = 1
+
+_HEADER = struct.Struct('<4sHxxqQIIII')
+_ENTRY = struct.Struct('<IHBxII')
+_ORDER = struct.Struct('<I')
+
+
+def pack_path(json_path):
+    """Return the path of the pack compiled from a device JSON file."""
+    return os.path.splitext(json_path)[0] + PACK_EXTENSION
+
+
+def _flatten(commands, prefix=()):
+    """Yield (path, value) for every command leaf, in file order."""
+    for key, value in commands.items():
+        path = prefix + (key,)
+        if isinstance(value, dict) and value:
+            yield from _flatten(value, path)
+        else:
+            yield path, value
+
+
+def compile_pack(json_path, dest=None):
+    """Compile a device JSON file into a pack and return the pack path."""
+    dest = dest or pack_path(json_path)
+    stat = os.stat(json_path)
+
+    with open(json_path, 'rb') as f:
+        device_data = json.load(f)
+
+    commands = device_data.pop('commands')
+    info = json.dumps(device_data, separators=(',', ':')).encode('utf-8')
+
+    entries = []
+    keys = bytearray()
+    payloads = bytearray()
+    offsets = {}
+
+    for path, value in _flatten(commands):
+        key = KEY_SEPARATOR.join(path).encode('utf-8')
+
+        if isinstance(value, str):
+            kind, payload = KIND_STRING, value.encode('utf-8')
+        else:
+            kind = KIND_JSON
+            payload = json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+        if payload not in offsets:
+            offsets[payload] = len(payloads)
+            payloads += payload
+
+        entries.append((len(keys), len(key), kind, offsets[payload], len(payload)))
+        keys += key
+
+    order = sorted(range(len(entries)),
+                   key=lambda i: keys[entries[i][0]:entries[i][0] + entries[i][1]])
+
+    directory = os.path.dirname(os.path.abspath(dest))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(
+                MAGIC, FORMAT_VERSION, stat.st_mtime_ns, stat.st_size,
+                len(info), len(entries), len(keys), len(payloads)))
+            f.write(info)
+            for entry in entries:
+                f.write(_ENTRY.pack(*entry))
+            for index in order:
+                f.write(_ORDER.pack(index))
+            f.write(keys)
+            f.write(payloads)
+
+        # Packs are memory-mapped while in use, never rewrite them in place.
+        os.replace(tmp_path, dest)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    return dest
+
+
+class CodePack:
+    """A memory-mapped device pack."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, version, self.source_mtime, self.source_size, info_len,
+         self._count, keys_len, _) = _HEADER.unpack_from(self._buf)
+
+        if magic != MAGIC or version != FORMAT_VERSION:
+            self._buf.close()
+            raise ValueError("{} is not a supported device pack".format(path))
+
+        self.path = path
+        self.info = json.loads(self._buf[_HEADER.size:_HEADER.size + info_len])
+        self._entries = _HEADER.size + info_len
+        self._order = self._entries + self._count * _ENTRY.size
+        self._keys = self._order + self._count * _ORDER.size
+        self._payloads = self._keys + keys_len
+        self._view = memoryview(self._buf)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def mapped_size(self):
+        """Return the size of the memory-mapped pack file."""
+        return len(self._buf)
+
+    @property
+    def commands(self):
+        """Return the root of the commands tree."""
+        return PackNode(self, ())
+
+    def is_fresh(self, stat):
+        """Return True if the pack was compiled from the file with stat."""
+        return (self.source_mtime, self.source_size) == \
+            (stat.st_mtime_ns, stat.st_size)
+
+    def _entry(self, index):
+        return _ENTRY.unpack_from(self._buf, self._entries + index * _ENTRY.size)
+
+    def _key(self, index):
+        key_offset, key_len, _, _, _ = self._entry(index)
+        start = self._keys + key_offset
+        return self._buf[start:start + key_len]
+
+    def _sorted_key(self, position):
+        (index,) = _ORDER.unpack_from(self._buf, self._order + position * _ORDER.size)
+        return index, self._key(index)
+
+    def _bisect(self, key):
+        """Return the first position in the sorted order with a key >= key."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._sorted_key(middle)[1] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, key):
+        """Return the entry index of a leaf key, or None."""
+        position = self._bisect(key)
+        if position < self._count:
+            index, found = self._sorted_key(position)
+            if found == key:
+                return index
+        return None
+
+    def has_prefix(self, prefix):
+        """Return True if any key starts with prefix."""
+        position = self._bisect(prefix)
+        return position < self._count and \
+            self._sorted_key(position)[1].startswith(prefix)
+
+    def value(self, index):
+        """Decode the payload of an entry."""
+        _, _, kind, offset, length = self._entry(index)
+        start = self._payloads + offset
+        payload = self._view[start:start + length]
+
+        if kind == KIND_STRING:
+            return str(payload, 'utf-8')
+        return json.loads(str(payload, 'utf-8'))
+
+    def unique_payloads(self):
+        """Return the number of distinct payloads stored in the pack."""
+        return len({self._entry(index)[3] for index in range(self._count)})
+
+    def children(self, prefix):
+        """Return the distinct key components following prefix, in file order."""
+        children = {}
+
+        for index in range(self._count):
+            key = self._key(index)
+            if key.startswith(prefix):
+                child = key[len(prefix):].split(_SEPARATOR, 1)[0]
+                children.setdefault(child.decode('utf-8'), None)
+
+        return list(children)
+
+
+class PackNode(Mapping):
+    """Read-only mapping over the commands of a pack below a key path."""
+
+    def __init__(self, pack, path):
+        self._pack = pack
+        self._path = path
+
+    @property
+    def pack(self):
+        """Return the pack the node belongs to."""
+        return self._pack
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            raise KeyError(key)
+
+        path = self._path + (key,)
+        encoded = KEY_SEPARATOR.join(path).encode('utf-8')
+        index = self._pack.find(encoded)
+
+        if index is not None:
+            return self._pack.value(index)
+        if self._pack.has_prefix(encoded + _SEPARATOR):
+            return PackNode(self._pack, path)
+        raise KeyError(key)
+
+    def __iter__(self):
+        prefix = KEY_SEPARATOR.join(self._path).encode('utf-8')
+        if self._path:
+            prefix += _SEPARATOR
+        return iter(self._pack.children(prefix))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+def main(argv):
+    """Compile the device files or directories given on the command line."""
+    if not argv:
+        print(__doc__.strip())
+        return 1
+
+    failed = False
+
+    for target in argv:
+        if os.path.isdir(target):
+            paths = sorted(os.path.join(target, name)
+                           for name in os.listdir(target)
+                           if name.endswith('.json'))
+        else:
+            paths = [target]
+
+        for path in paths:
+            try:
+                dest = compile_pack(path)
+                print("{} -> {}".format(path, dest))
+            except Exception as e:
+                failed = True
+                print("{}: {}".format(path, e), file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,20 @@
 from abc import ABC, abstractmethod
-from base64 import b64encode
-import binascii
-import requests
+from array import array
+import asyncio
+from collections import OrderedDict
+from collections.abc import Mapping
+import aiohttp
 import logging
 import json
+import voluptuous as vol
 
 from homeassistant.const import ATTR_ENTITY_ID
-from . import Helper
+from homeassistant.helpers.aiohttp_client import async_create_clientsession
+import homeassistant.helpers.config_validation as cv
+from . import DOMAIN, Helper
+from .profiles import LazyCommands
+from .scheduler import get_scheduler, priority_from_context
+from .stats import get_stats, timed, track
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -27,8 +35,122 @@ MQTT_COMMANDS_ENCODING = [ENC_RAW]
 LOOKIN_COMMANDS_ENCODING = [ENC_PRONTO, ENC_RAW]
 ESPHOME_COMMANDS_ENCODING = [ENC_RAW]
 
+OPT_PRECOMPUTE = 'precompute'
+OPT_CONNECT_TIMEOUT = 'connect_timeout'
+OPT_READ_TIMEOUT = 'read_timeout'
+OPT_MAX_CONNECTIONS = 'max_connections'
+OPT_QOS = 'qos'
+OPT_RETAIN = 'retain'
+OPT_SPACING = 'spacing'
+OPT_BATCH = 'batch'
+
+CONTROLLER_OPTIONS_SCHEMA = vol.Schema({
+    vol.Optional(OPT_PRECOMPUTE): cv.boolean,
+    vol.Optional(OPT_CONNECT_TIMEOUT): cv.positive_float,
+    vol.Optional(OPT_READ_TIMEOUT): cv.positive_float,
+    vol.Optional(OPT_MAX_CONNECTIONS): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(OPT_QOS): vol.All(vol.Coerce(int), vol.In([0, 1, 2])),
+    vol.Optional(OPT_RETAIN): cv.boolean,
+    vol.Optional(OPT_SPACING): cv.positive_float,
+    vol.Optional(OPT_BATCH): cv.boolean
+})
+
+LOOKIN_CONNECT_TIMEOUT = 5
+LOOKIN_READ_TIMEOUT = 10
+LOOKIN_MAX_CONNECTIONS = 2
+LOOKIN_SESSIONS = 'lookin_sessions'
+
+COMMAND_CACHE_SIZE = 512
+
+
+class CommandCache:
+    """Bounded LRU cache of commands converted to a controller format.
+
+    Pinned entries are not evicted until every controller that pinned them
+    released them. They are used for the commands a controller converts
+    ahead of time.
+    """
+
+    def __init__(self, maxsize=COMMAND_CACHE_SIZE):
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+        self._pinned = {}
+        self._pins = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return a cached command or None."""
+        value = self._pinned.get(key)
+
+        if value is None:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Cache a command, evicting the least recently used ones."""
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def pin(self, key, value):
+        """Cache a command that is not evicted until unpinned."""
+        self._items.pop(key, None)
+        self._pinned[key] = value
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def unpin(self, key):
+        """Release a pin. Unpinned commands are cached as recently used."""
+        pins = self._pins.pop(key, 0) - 1
+
+        if pins > 0:
+            self._pins[key] = pins
+        elif key in self._pinned:
+            self.put(key, self._pinned.pop(key))
+
+    def clear(self):
+        """Drop all the cached commands, pinned ones included."""
+        self._items.clear()
+        self._pinned.clear()
+        self._pins.clear()
+
+    def info(self):
+        """Return the cache statistics."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._items),
+            'maxsize': self._maxsize,
+            'pinned': len(self._pinned),
+        }
+
+    def memory_usage(self, sizeof):
+        """Return the memory held by the cached commands, measured by sizeof."""
+        return sizeof(self._items) + sizeof(self._pinned)
+
+
+def iter_commands(commands):
+    """Yield every command string of a commands tree."""
+    if isinstance(commands, str):
+        yield commands
+    elif isinstance(commands, list):
+        for command in commands:
+            yield from iter_commands(command)
+    elif isinstance(commands, Mapping):
+        for command in commands.values():
+            yield from iter_commands(command)
 
-def get_controller(hass, controller, encoding, controller_data, delay):
+
+def get_controller(hass, controller, encoding, controller_data, delay, options=None):
     """Return a controller compatible with the specification provided."""
     controllers = {
         BROADLINK_CONTROLLER: BroadlinkController,
@@ -38,78 +160,215 @@ def get_controller(hass, controller, encoding, controller_data, delay):
         ESPHOME_CONTROLLER: ESPHomeController
     }
     try:
-        return controllers[controller](hass, controller, encoding, controller_data, delay)
+        return controllers[controller](
+            hass, controller, encoding, controller_data, delay, options)
     except KeyError:
         raise Exception("The controller is not supported.")
 
 
 class AbstractController(ABC):
     """Representation of a controller."""
-    def __init__(self, hass, controller, encoding, controller_data, delay):
+
+    # The cache of the commands pinned by async_prepare, if any
+    command_cache = None
+
+    def __init__(self, hass, controller, encoding, controller_data, delay,
+                 options=None):
         self.check_encoding(encoding)
         self.hass = hass
         self._controller = controller
         self._encoding = encoding
         self._controller_data = controller_data
         self._delay = delay
+        self._options = options or {}
+        self._scheduler = get_scheduler(hass, controller, controller_data)
+        self._stats = get_stats(hass, 'hubs', self._scheduler.key)
+        self._pinned = set()
+        self._released = False
 
     @abstractmethod
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         pass
 
-    @abstractmethod
-    async def send(self, command):
+    @property
+    def hub(self):
+        """Return the key of the hub the commands are transmitted through."""
+        return self._scheduler.key
+
+    async def send(self, command, context=None):
         """Send a command."""
+        await self._async_run(lambda: self._send(command), context)
+
+    async def send_sequence(self, commands, delay=None, context=None):
+        """Send several commands in order, delay seconds apart."""
+        await self._async_run(
+            lambda: self._send_sequence(commands, delay), context)
+
+    async def send_repeated(self, command, count, delay=None, context=None):
+        """Send the same command count times, delay seconds apart."""
+        await self._async_run(
+            lambda: self._send_repeated(command, count, delay), context)
+
+    async def _async_run(self, job, context):
+        """Run a transmission through the hub scheduler and time it."""
+        with track(self._stats):
+            await self._scheduler.async_run(job, priority_from_context(context))
+
+    @abstractmethod
+    async def _send(self, command):
+        """Transmit a command through the hub."""
+        pass
+
+    async def _send_sequence(self, commands, delay):
+        """Transmit several commands in order.
+
+        Controllers able to transmit a list of commands in a single call
+        override this, the others transmit the commands one by one.
+        """
+        if delay is None:
+            delay = self._delay
+
+        for index, command in enumerate(commands):
+            if index:
+                with timed('sleep'):
+                    await asyncio.sleep(float(delay))
+            await self._send(command)
+
+    async def _send_repeated(self, command, count, delay):
+        """Transmit the same command count times."""
+        await self._send_sequence([command] * count, delay)
+
+    async def async_prepare(self, commands):
+        """Prepare the commands of a device before they are sent.
+
+        Errors are logged, the commands are then prepared when sent.
+        """
+        try:
+            await self._async_prepare(commands)
+        except Exception as e:
+            _LOGGER.error("Error while preparing the %s commands for %s: %s",
+                          self._encoding, self._controller_data, e)
+
+    async def _async_prepare(self, commands):
+        """Prepare the commands, controllers caching them override this."""
         pass
 
+    def _pin_all(self, keys, values):
+        """Pin prepared commands in the command cache until released."""
+        if self._released:
+            return
+
+        for key, value in zip(keys, values):
+            if key not in self._pinned:
+                self._pinned.add(key)
+                self.command_cache.pin(key, value)
+
+    def release(self):
+        """Release the commands pinned for the entity being removed."""
+        self._released = True
+
+        for key in self._pinned:
+            self.command_cache.unpin(key)
+        self._pinned.clear()
+
+    async def _async_list_commands(self, commands):
+        """Return every command string of a commands tree.
+
+        Lazily loaded subtrees are loaded first, from the event loop, so
+        the tree is never read nor modified from the executor.
+        """
+        if isinstance(commands, LazyCommands):
+            await commands.async_load_all(self.hass)
+        return list(iter_commands(commands))
+
 
 class BroadlinkController(AbstractController):
     """Controls a Broadlink device."""
 
+    # Shared by all the Broadlink controllers, keyed by (encoding, command)
+    command_cache = CommandCache()
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in BROADLINK_COMMANDS_ENCODING:
             raise Exception("The encoding is not supported "
                             "by the Broadlink controller.")
 
-    async def send(self, command):
+    async def _async_prepare(self, commands):
+        """Convert all the commands ahead of time if enabled."""
+        if self._encoding == ENC_BASE64 or not self._options.get(OPT_PRECOMPUTE):
+            return
+
+        commands = await self._async_list_commands(commands)
+        converted = await self.hass.async_add_executor_job(
+            self._convert_all, commands)
+        self._pin_all([(self._encoding, command) for command in commands],
+                      converted)
+        _LOGGER.debug("Precomputed %d %s commands", len(commands), self._encoding)
+
+    def _convert_all(self, commands):
+        return ['b64:' + converted
+                for converted in Helper.convert_batch(commands, self._encoding)]
+
+    def _convert(self, command):
+        """Convert a command to the Base64 encoding."""
+        try:
+            return 'b64:' + Helper.base64_converter(self._encoding)(command)
+        except:
+            raise Exception("Error while converting "
+                            "{} to Base64 encoding".format(self._encoding))
+
+    def _get_converted(self, command):
+        """Return a converted command, using the cache if possible."""
+        if self._encoding == ENC_BASE64:
+            return 'b64:' + command
+
+        key = (self._encoding, command)
+        converted = self.command_cache.get(key)
+
+        if converted is None:
+            with timed('convert'):
+                converted = self._convert(command)
+            self.command_cache.put(key, converted)
+
+        return converted
+
+    async def _send(self, command):
         """Send a command."""
-        commands = []
-
-        if not isinstance(command, list): 
-            command = [command]
-
-        for _command in command:
-            if self._encoding == ENC_HEX:
-                try:
-                    _command = binascii.unhexlify(_command)
-                    _command = b64encode(_command).decode('utf-8')
-                except:
-                    raise Exception("Error while converting "
-                                    "Hex to Base64 encoding")
-
-            if self._encoding == ENC_PRONTO:
-                try:
-                    _command = _command.replace(' ', '')
-                    _command = bytearray.fromhex(_command)
-                    _command = Helper.pronto2lirc(_command)
-                    _command = Helper.lirc2broadlink(_command)
-                    _command = b64encode(_command).decode('utf-8')
-                except:
-                    raise Exception("Error while converting "
-                                    "Pronto to Base64 encoding")
-
-            commands.append('b64:' + _command)
+        await self._send_converted([command])
+
+    async def _send_sequence(self, commands, delay):
+        """Send several commands in a single service call."""
+        await self._send_converted(commands, delay)
+
+    async def _send_repeated(self, command, count, delay):
+        """Send the same command count times in a single service call."""
+        await self._send_converted([command], delay, count)
+
+    async def _send_converted(self, commands, delay=None, repeats=1):
+        if delay is None:
+            delay = self._delay
+
+        converted = []
+
+        for command in commands:
+            if not isinstance(command, list):
+                command = [command]
+            converted.extend(self._get_converted(_command) for _command in command)
 
         service_data = {
             ATTR_ENTITY_ID: self._controller_data,
-            'command':  commands,
-            'delay_secs': self._delay
+            'command':  converted,
+            'delay_secs': delay
         }
 
-        await self.hass.services.async_call(
-            'remote', 'send_command', service_data)
+        if repeats > 1:
+            service_data['num_repeats'] = repeats
+
+        with timed('call'):
+            await self.hass.services.async_call(
+                'remote', 'send_command', service_data)
 
 
 class XiaomiController(AbstractController):
@@ -121,15 +380,16 @@ class XiaomiController(AbstractController):
             raise Exception("The encoding is not supported "
                             "by the Xiaomi controller.")
 
-    async def send(self, command):
+    async def _send(self, command):
         """Send a command."""
         service_data = {
             ATTR_ENTITY_ID: self._controller_data,
             'command':  self._encoding.lower() + ':' + command
         }
 
-        await self.hass.services.async_call(
-            'remote', 'send_command', service_data)
+        with timed('call'):
+            await self.hass.services.async_call(
+                'remote', 'send_command', service_data)
 
 
 class MQTTController(AbstractController):
@@ -141,15 +401,44 @@ class MQTTController(AbstractController):
             raise Exception("The encoding is not supported "
                             "by the mqtt controller.")
 
-    async def send(self, command):
-        """Send a command."""
+    async def _publish(self, payload):
         service_data = {
             'topic': self._controller_data,
-            'payload': command
+            'payload': payload,
+            'qos': self._options.get(OPT_QOS, 0),
+            'retain': self._options.get(OPT_RETAIN, False)
         }
 
-        await self.hass.services.async_call(
-            'mqtt', 'publish', service_data)
+        with timed('call'):
+            await self.hass.services.async_call(
+                'mqtt', 'publish', service_data)
+
+    async def _send(self, command):
+        """Send a command."""
+        await self._publish(command)
+
+    async def _send_sequence(self, commands, delay):
+        """Publish several commands in order.
+
+        With the batch option, the commands are published at once as a
+        JSON array for firmwares able to replay it. Otherwise they are
+        published one after the other, spacing seconds apart.
+        """
+        commands = list(iter_commands(commands))
+
+        if self._options.get(OPT_BATCH):
+            await self._publish(json.dumps(commands))
+            return
+
+        spacing = self._options.get(OPT_SPACING)
+        if spacing is None:
+            spacing = self._delay if delay is None else delay
+
+        for index, command in enumerate(commands):
+            if index and float(spacing):
+                with timed('sleep'):
+                    await asyncio.sleep(float(spacing))
+            await self._publish(command)
 
 
 class LookinController(AbstractController):
@@ -161,26 +450,127 @@ class LookinController(AbstractController):
             raise Exception("The encoding is not supported "
                             "by the LOOKin controller.")
 
-    async def send(self, command):
+    def _get_session(self):
+        """Return the keep-alive HTTP session of the device and options.
+
+        The controllers of a device configured with the same options share
+        a session, along with a semaphore limiting its concurrent requests.
+        Home Assistant closes the sessions when it stops.
+        """
+        connect_timeout = self._options.get(
+            OPT_CONNECT_TIMEOUT, LOOKIN_CONNECT_TIMEOUT)
+        read_timeout = self._options.get(OPT_READ_TIMEOUT, LOOKIN_READ_TIMEOUT)
+        max_connections = self._options.get(
+            OPT_MAX_CONNECTIONS, LOOKIN_MAX_CONNECTIONS)
+
+        sessions = self.hass.data.setdefault(DOMAIN, {}).setdefault(
+            LOOKIN_SESSIONS, {})
+        key = (self._controller_data, connect_timeout, read_timeout,
+               max_connections)
+        session = sessions.get(key)
+
+        if session is None or session[0].closed:
+            timeout = aiohttp.ClientTimeout(
+                sock_connect=connect_timeout, sock_read=read_timeout)
+            session = sessions[key] = (
+                async_create_clientsession(self.hass, timeout=timeout),
+                asyncio.Semaphore(max_connections))
+
+        return session
+
+    async def _send(self, command):
         """Send a command."""
         encoding = self._encoding.lower().replace('pronto', 'prontohex')
         url = f"http://{self._controller_data}/commands/ir/" \
                 f"{encoding}/{command}"
-        await self.hass.async_add_executor_job(requests.get, url)
+
+        session, connections = self._get_session()
+
+        with timed('call'):
+            async with connections, session.get(url) as response:
+                await response.read()
+                if response.status != 200:
+                    raise Exception("The LOOKin device returned HTTP status "
+                                    "{}".format(response.status))
 
 
 class ESPHomeController(AbstractController):
     """Controls a ESPHome device."""
 
+    # Shared by all the ESPHome controllers, keyed by the Raw command
+    command_cache = CommandCache()
+
     def check_encoding(self, encoding):
         """Check if the encoding is supported by the controller."""
         if encoding not in ESPHOME_COMMANDS_ENCODING:
             raise Exception("The encoding is not supported "
                             "by the ESPHome controller.")
-    
-    async def send(self, command):
-        """Send a command."""
-        service_data = {'command':  json.loads(command)}
 
-        await self.hass.services.async_call(
-            'esphome', self._controller_data, service_data)
\ No newline at end of file
+    async def _async_prepare(self, commands):
+        """Decode all the commands ahead of time if enabled."""
+        if not self._options.get(OPT_PRECOMPUTE):
+            return
+
+        commands = await self._async_list_commands(commands)
+        decoded = await self.hass.async_add_executor_job(
+            self._decode_all, commands)
+        self._pin_all(commands, decoded)
+        _LOGGER.debug("Predecoded %d Raw commands", len(commands))
+
+    def _decode_all(self, commands):
+        return [self._decode(command) for command in commands]
+
+    def _decode(self, command):
+        """Decode a Raw command to an array of timings."""
+        try:
+            return array('i', json.loads(command))
+        except (ValueError, TypeError, OverflowError):
+            raise Exception("Error while decoding the Raw command")
+
+    def _get_decoded(self, command):
+        """Return a decoded command, using the cache if possible."""
+        decoded = self.command_cache.get(command)
+
+        if decoded is None:
+            with timed('convert'):
+                decoded = self._decode(command)
+            self.command_cache.put(command, decoded)
+
+        return decoded
+
+    async def _call_service(self, timings):
+        service_data = {'command': timings.tolist()}
+
+        with timed('call'):
+            await self.hass.services.async_call(
+                'esphome', self._controller_data, service_data)
+
+    async def _send(self, command):
+        """Send a command."""
+        await self._call_service(self._get_decoded(command))
+
+    async def _send_sequence(self, commands, delay):
+        """Send several commands.
+
+        With the batch option, the commands are joined into a single Raw
+        command, separated by a space of delay seconds, and sent in one
+        service call. Otherwise they are sent one by one.
+        """
+        if not self._options.get(OPT_BATCH):
+            await super()._send_sequence(commands, delay)
+            return
+
+        if delay is None:
+            delay = self._delay
+        gap = int(float(delay) * 1000000)
+        timings = array('i')
+
+        for command in iter_commands(commands):
+            if timings:
+                if timings[-1] < 0:
+                    timings[-1] -= gap
+                else:
+                    timings.append(-gap)
+            timings.extend(self._get_decoded(command))
+
+        await self._call_service(timings)
\ No newline at end of file
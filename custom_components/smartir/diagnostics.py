@@ -0,0 +1,101 @@
+"""Diagnostics of the SmartIR integration.
+
+SmartIR is set up from YAML, without config entries, so Home Assistant's
+diagnostics download is not available. The data is returned by the
+smartir.diagnostics, smartir.memory_report and smartir.setup_report
+services instead.
+"""
+from . import DOMAIN, ENTITIES
+from .controller import BroadlinkController, ESPHomeController
+from .profiles import PROFILE_CACHE, deep_sizeof
+from .scheduler import SCHEDULERS, hub_name
+from .stats import STATS
+from .tracing import get_setup_report
+
+COMMAND_CACHES = {
+    'Broadlink': BroadlinkController.command_cache,
+    'ESPHome': ESPHomeController.command_cache,
+}
+
+
+async def async_get_memory_report(hass):
+    """Return the memory held by the device profiles, entities and caches.
+
+    Objects shared between profiles, entities and caches are counted once,
+    by the first of them holding it. Memory-mapped code packs are reported
+    apart from the heap.
+
+    Runs in the event loop: lazily loaded profiles must not change while
+    they are measured.
+    """
+    seen = set()
+
+    profiles = {}
+    for profile in PROFILE_CACHE.profiles():
+        profiles['{}/{}'.format(*profile.key)] = profile.memory_usage(seen)
+
+    # Entities share the commands of their profile, only the parts they
+    # copied to modify them are their own
+    entities = {}
+    for entity_id, entity in hass.data.get(DOMAIN, {}).get(ENTITIES, {}).items():
+        entities[entity_id] = {
+            'profile': '{}/{}'.format(*entity._profile.key),
+            'deep_size': deep_sizeof(entity._commands, seen),
+        }
+
+    caches = {}
+    for name, cache in COMMAND_CACHES.items():
+        caches[name] = {
+            'deep_size': cache.memory_usage(lambda obj: deep_sizeof(obj, seen)),
+        }
+
+    heap = sum(usage['deep_size']
+               for usages in (profiles, entities, caches)
+               for usage in usages.values())
+
+    return {
+        'total': {
+            'heap_size': heap,
+            'mapped_size': sum(usage.get('mapped_size', 0)
+                               for usage in profiles.values()),
+            'profiles': len(profiles),
+            'unique_payloads': sum(usage['unique_payloads']
+                                   for usage in profiles.values()),
+            'total_payloads': sum(usage['total_payloads']
+                                  for usage in profiles.values()),
+        },
+        'profiles': profiles,
+        'entities': entities,
+        'command_caches': caches,
+    }
+
+
+async def async_get_diagnostics(hass):
+    """Return the diagnostics of all the SmartIR hubs and entities."""
+    domain_data = hass.data.get(DOMAIN, {})
+    hub_stats = domain_data.get(STATS, {}).get('hubs', {})
+    schedulers = domain_data.get(SCHEDULERS, {})
+
+    hubs = {}
+    for key, stats in hub_stats.items():
+        hubs[hub_name(key)] = stats.as_dict()
+        if key in schedulers:
+            hubs[hub_name(key)]['queue_depth'] = schedulers[key].queue_depth
+
+    entities = {}
+    for entity_id, entity in domain_data.get(ENTITIES, {}).items():
+        entities[entity_id] = {
+            'hub': hub_name(entity._controller.hub),
+            'send_stats': entity._send_stats.as_dict(),
+        }
+        if hasattr(entity, '_saved_sends'):
+            entities[entity_id]['saved_sends'] = entity._saved_sends
+
+    return {
+        'hubs': hubs,
+        'entities': entities,
+        'command_caches': {name: cache.info()
+                           for name, cache in COMMAND_CACHES.items()},
+        'memory': await async_get_memory_report(hass),
+        'setup': get_setup_report(hass),
+    }
@@ -1,8 +1,5 @@
 import asyncio
-import aiofiles
-import json
 import logging
-import os.path
 
 import voluptuous as vol
 
@@ -19,19 +16,26 @@ from homeassistant.util.percentage import (
     ordered_list_item_to_percentage,
     percentage_to_ordered_list_item
 )
-from . import COMPONENT_ABS_DIR, Helper
-from .controller import get_controller
+from . import register_entity, unregister_entity
+from .controller import CONTROLLER_OPTIONS_SCHEMA, get_controller
+from .fingerprint import LastSentState, state_fingerprint
+from .profiles import PROFILE_CACHE, async_get_device_profile
+from .stats import SendStats, track_entity_send
+from .tracing import trace_setup, traced
 
 _LOGGER = logging.getLogger(__name__)
 
 DEFAULT_NAME = "SmartIR Fan"
 DEFAULT_DELAY = 0.5
+DEFAULT_RESEND_WINDOW = 0.0
 
 CONF_UNIQUE_ID = 'unique_id'
 CONF_DEVICE_CODE = 'device_code'
 CONF_CONTROLLER_DATA = "controller_data"
 CONF_DELAY = "delay"
+CONF_CONTROLLER_OPTIONS = 'controller_options'
 CONF_POWER_SENSOR = 'power_sensor'
+CONF_RESEND_WINDOW = 'resend_window'
 
 SPEED_OFF = "off"
 
@@ -41,60 +45,42 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_DEVICE_CODE): cv.positive_int,
     vol.Required(CONF_CONTROLLER_DATA): cv.string,
     vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.string,
-    vol.Optional(CONF_POWER_SENSOR): cv.entity_id
+    vol.Optional(CONF_CONTROLLER_OPTIONS, default={}): CONTROLLER_OPTIONS_SCHEMA,
+    vol.Optional(CONF_POWER_SENSOR): cv.entity_id,
+    vol.Optional(CONF_RESEND_WINDOW, default=DEFAULT_RESEND_WINDOW): cv.positive_float
 })
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the IR Fan platform."""
     device_code = config.get(CONF_DEVICE_CODE)
-    device_files_subdir = os.path.join('codes', 'fan')
-    device_files_absdir = os.path.join(COMPONENT_ABS_DIR, device_files_subdir)
-
-    if not os.path.isdir(device_files_absdir):
-        os.makedirs(device_files_absdir)
-
-    device_json_filename = str(device_code) + '.json'
-    device_json_path = os.path.join(device_files_absdir, device_json_filename)
-
-    if not os.path.exists(device_json_path):
-        _LOGGER.warning("Couldn't find the device Json file. The component will " \
-                        "try to download it from the GitHub repo.")
-
-        try:
-            codes_source = ("https://raw.githubusercontent.com/"
-                            "smartHomeHub/SmartIR/master/"
-                            "codes/fan/{}.json")
-
-            await Helper.downloader(codes_source.format(device_code), device_json_path)
-        except Exception:
-            _LOGGER.error("There was an error while downloading the device Json file. " \
-                          "Please check your internet connection or if the device code " \
-                          "exists on GitHub. If the problem still exists please " \
-                          "place the file manually in the proper directory.")
+
+    with trace_setup(hass, 'fan', device_code, config.get(CONF_NAME)):
+        profile = await async_get_device_profile(hass, 'fan', device_code)
+
+        if profile is None:
             return
 
-    try:
-        async with aiofiles.open(device_json_path, mode='r') as j:
-            _LOGGER.debug(f"loading json file {device_json_path}")
-            content = await j.read()
-            device_data = json.loads(content)
-            _LOGGER.debug(f"{device_json_path} file loaded")
-    except Exception:
-        _LOGGER.error("The device JSON file is invalid")
-        return
+        with traced('build'):
+            try:
+                entity = SmartIRFan(hass, config, profile)
+            except Exception:
+                # The profile would never be evicted otherwise
+                PROFILE_CACHE.release(profile)
+                raise
 
-    async_add_entities([SmartIRFan(
-        hass, config, device_data
-    )])
+            async_add_entities([entity])
 
 class SmartIRFan(FanEntity, RestoreEntity):
-    def __init__(self, hass, config, device_data):
+    def __init__(self, hass, config, profile):
+        device_data = profile.data
         self.hass = hass
+        self._profile = profile
         self._unique_id = config.get(CONF_UNIQUE_ID)
         self._name = config.get(CONF_NAME)
         self._device_code = config.get(CONF_DEVICE_CODE)
         self._controller_data = config.get(CONF_CONTROLLER_DATA)
         self._delay = config.get(CONF_DELAY)
+        self._controller_options = config.get(CONF_CONTROLLER_OPTIONS)
         self._power_sensor = config.get(CONF_POWER_SENSOR)
 
         self._manufacturer = device_data['manufacturer']
@@ -125,7 +111,9 @@ class SmartIRFan(FanEntity, RestoreEntity):
 
 
         self._temp_lock = asyncio.Lock()
+        self._send_stats = SendStats()
         self._on_by_remote = False
+        self._last_sent = LastSentState(config.get(CONF_RESEND_WINDOW))
 
         #Init the IR/RF controller
         self._controller = get_controller(
@@ -133,11 +121,15 @@ class SmartIRFan(FanEntity, RestoreEntity):
             self._supported_controller, 
             self._commands_encoding,
             self._controller_data,
-            self._delay)
+            self._delay,
+            self._controller_options)
 
     async def async_added_to_hass(self):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
+        register_entity(self.hass, self)
+        self.hass.async_create_task(
+            self._controller.async_prepare(self._commands))
     
         last_state = await self.async_get_last_state()
 
@@ -154,10 +146,19 @@ class SmartIRFan(FanEntity, RestoreEntity):
             if 'last_on_speed' in last_state.attributes:
                 self._last_on_speed = last_state.attributes['last_on_speed']
 
+            self._last_sent.restore(last_state.attributes)
+
             if self._power_sensor:
                 async_track_state_change(self.hass, self._power_sensor, 
                                          self._async_power_sensor_changed)
 
+    async def async_will_remove_from_hass(self):
+        """Release the shared device profile and the prepared commands."""
+        await super().async_will_remove_from_hass()
+        unregister_entity(self.hass, self)
+        self._controller.release()
+        PROFILE_CACHE.release(self._profile)
+
     @property
     def unique_id(self):
         """Return a unique ID."""
@@ -219,6 +220,7 @@ class SmartIRFan(FanEntity, RestoreEntity):
             'supported_models': self._supported_models,
             'supported_controller': self._supported_controller,
             'commands_encoding': self._commands_encoding,
+            **self._last_sent.attributes
         }
 
     async def async_set_percentage(self, percentage: int):
@@ -263,8 +265,13 @@ class SmartIRFan(FanEntity, RestoreEntity):
         """Turn off the fan."""
         await self.async_set_percentage(0)
 
-    async def send_command(self):
-        async with self._temp_lock:
+    async def async_resend_state(self):
+        """Send the current state, even if it was just sent."""
+        await self.send_command(force=True)
+        self.async_write_ha_state()
+
+    async def send_command(self, force=False):
+        async with track_entity_send(self._send_stats, self._temp_lock) as timer:
             self._on_by_remote = False
             speed = self._speed
             direction = self._direction or 'default'
@@ -272,15 +279,25 @@ class SmartIRFan(FanEntity, RestoreEntity):
 
             if speed.lower() == SPEED_OFF:
                 command = self._commands['off']
+                fingerprint = state_fingerprint(SPEED_OFF)
             elif oscillating:
                 command = self._commands['oscillate']
+                fingerprint = state_fingerprint(speed, 'oscillate')
             else:
                 command = self._commands[direction][speed] 
+                fingerprint = state_fingerprint(speed, direction)
+
+            if not force and self._last_sent.is_redundant(fingerprint):
+                _LOGGER.debug("%s: the state was just sent, skipping it",
+                              self._name)
+                return
 
             try:
-                await self._controller.send(command)
+                await self._controller.send(command, context=self._context)
+                self._last_sent.record(fingerprint)
             except Exception as e:
                 _LOGGER.exception(e)
+                timer.error = True
 
     async def _async_power_sensor_changed(self, entity_id, old_state, new_state):
         """Handle power sensor changes."""
@@ -290,8 +307,11 @@ class SmartIRFan(FanEntity, RestoreEntity):
         if new_state.state == old_state.state:
             return
 
+        #The device was operated otherwise (e.g. by its own remote) if the
+        #sensor disagrees with the last state sent
         if new_state.state == STATE_ON and self._speed == SPEED_OFF:
             self._on_by_remote = True
+            self._last_sent.invalidate()
             self._speed = None
             self.async_write_ha_state()
 
@@ -299,4 +319,5 @@ class SmartIRFan(FanEntity, RestoreEntity):
             self._on_by_remote = False
             if self._speed != SPEED_OFF:
                 self._speed = SPEED_OFF
+                self._last_sent.invalidate()
             self.async_write_ha_state()
\ No newline at end of file
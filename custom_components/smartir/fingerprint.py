@@ -0,0 +1,65 @@
+"""Fingerprints of the last state transmitted by the SmartIR entities."""
+import hashlib
+import json
+import time
+
+ATTR_LAST_SENT_FINGERPRINT = 'last_sent_fingerprint'
+ATTR_LAST_SENT_AT = 'last_sent_at'
+
+
+def state_fingerprint(*state):
+    """Return a short, stable fingerprint of a device state."""
+    data = json.dumps(state, default=str, separators=(',', ':'))
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class LastSentState:
+    """The last state an entity transmitted successfully.
+
+    Transmitting the same state again within `window` seconds is
+    redundant. A window of 0 never considers a transmission redundant.
+    """
+
+    def __init__(self, window):
+        self._window = window
+        self.fingerprint = None
+        self.sent_at = None
+
+    def is_redundant(self, fingerprint):
+        """Return True if the state was transmitted within the window."""
+        if not self._window or fingerprint != self.fingerprint:
+            return False
+        return time.time() - self.sent_at < self._window
+
+    def record(self, fingerprint):
+        """Remember a state that was just transmitted."""
+        self.fingerprint = fingerprint
+        self.sent_at = time.time()
+
+    def invalidate(self):
+        """Forget the last state, e.g. when the device was operated otherwise."""
+        self.fingerprint = None
+        self.sent_at = None
+
+    def restore(self, attributes):
+        """Restore the last state from the attributes of an entity state."""
+        fingerprint = attributes.get(ATTR_LAST_SENT_FINGERPRINT)
+        sent_at = attributes.get(ATTR_LAST_SENT_AT)
+
+        if fingerprint is not None and isinstance(sent_at, (int, float)):
+            self.fingerprint = fingerprint
+            self.sent_at = sent_at
+
+    @property
+    def attributes(self):
+        """Return the state attributes persisting the last state.
+
+        They are only needed, and exposed, when a window is set.
+        """
+        if not self._window:
+            return {}
+
+        return {
+            ATTR_LAST_SENT_FINGERPRINT: self.fingerprint,
+            ATTR_LAST_SENT_AT: self.sent_at
+        }
@@ -1,8 +1,5 @@
 import asyncio
-import aiofiles
-import json
 import logging
-import os.path
 
 import voluptuous as vol
 
@@ -22,8 +19,11 @@ from homeassistant.core import callback
 from homeassistant.helpers.event import async_track_state_change_event
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreEntity
-from . import COMPONENT_ABS_DIR, Helper
-from .controller import get_controller
+from . import register_entity, unregister_entity
+from .controller import CONTROLLER_OPTIONS_SCHEMA, get_controller
+from .profiles import PROFILE_CACHE, async_get_device_profile
+from .stats import SendStats, track_entity_send
+from .tracing import trace_setup, traced
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -34,6 +34,7 @@ CONF_UNIQUE_ID = "unique_id"
 CONF_DEVICE_CODE = "device_code"
 CONF_CONTROLLER_DATA = "controller_data"
 CONF_DELAY = "delay"
+CONF_CONTROLLER_OPTIONS = "controller_options"
 CONF_POWER_SENSOR = "power_sensor"
 
 CMD_BRIGHTNESS_INCREASE = "brighten"
@@ -51,6 +52,7 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend(
         vol.Required(CONF_DEVICE_CODE): cv.positive_int,
         vol.Required(CONF_CONTROLLER_DATA): cv.string,
         vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.string,
+        vol.Optional(CONF_CONTROLLER_OPTIONS, default={}): CONTROLLER_OPTIONS_SCHEMA,
         vol.Optional(CONF_POWER_SENSOR): cv.entity_id,
     }
 )
@@ -64,52 +66,22 @@ async def async_setup_platform(
 ):
     """Set up the IR Light platform."""
     device_code = config.get(CONF_DEVICE_CODE)
-    device_files_subdir = os.path.join("codes", "light")
-    device_files_absdir = os.path.join(COMPONENT_ABS_DIR, device_files_subdir)
 
-    if not os.path.isdir(device_files_absdir):
-        os.makedirs(device_files_absdir)
+    with trace_setup(hass, "light", device_code, config.get(CONF_NAME)):
+        profile = await async_get_device_profile(hass, "light", device_code)
 
-    device_json_filename = str(device_code) + ".json"
-    device_json_path = os.path.join(device_files_absdir, device_json_filename)
-
-    if not os.path.exists(device_json_path):
-        _LOGGER.warning(
-            "Couldn't find the device Json file. The component "
-            "will try to download it from the Github repo."
-        )
-
-        try:
-            codes_source = (
-                "https://raw.githubusercontent.com/"
-                "smartHomeHub/SmartIR/master/"
-                "codes/light/{}.json"
-            )
-
-            await Helper.downloader(
-                codes_source.format(device_code),
-                device_json_path,
-            )
-        except Exception:
-            _LOGGER.error(
-                "There was an error while downloading the device Json file. "
-                "Please check your internet connection or if the device code "
-                "exists on GitHub. If the problem still exists please "
-                "place the file manually in the proper directory."
-            )
+        if profile is None:
             return
 
-    try:
-        async with aiofiles.open(device_json_path, mode='r') as j:
-            _LOGGER.debug(f"loading json file {device_json_path}")
-            content = await j.read()
-            device_data = json.loads(content)
-            _LOGGER.debug(f"{device_json_path} file loaded")
-    except Exception:
-        _LOGGER.error("The device JSON file is invalid")
-        return
+        with traced("build"):
+            try:
+                entity = SmartIRLight(hass, config, profile)
+            except Exception:
+                # The profile would never be evicted otherwise
+                PROFILE_CACHE.release(profile)
+                raise
 
-    async_add_entities([SmartIRLight(hass, config, device_data)])
+            async_add_entities([entity])
 
 
 # find the closest match in a sorted list
@@ -130,13 +102,16 @@ def closest_match(value, list):
 
 
 class SmartIRLight(LightEntity, RestoreEntity):
-    def __init__(self, hass, config, device_data):
+    def __init__(self, hass, config, profile):
+        device_data = profile.data
         self.hass = hass
+        self._profile = profile
         self._unique_id = config.get(CONF_UNIQUE_ID)
         self._name = config.get(CONF_NAME)
         self._device_code = config.get(CONF_DEVICE_CODE)
         self._controller_data = config.get(CONF_CONTROLLER_DATA)
         self._delay = config.get(CONF_DELAY)
+        self._controller_options = config.get(CONF_CONTROLLER_OPTIONS)
         self._power_sensor = config.get(CONF_POWER_SENSOR)
 
         self._manufacturer = device_data["manufacturer"]
@@ -152,6 +127,7 @@ class SmartIRLight(LightEntity, RestoreEntity):
         self._colortemp = None
 
         self._temp_lock = asyncio.Lock()
+        self._send_stats = SendStats()
         self._on_by_remote = False
         self._support_color_mode = ColorMode.UNKNOWN
 
@@ -187,11 +163,15 @@ class SmartIRLight(LightEntity, RestoreEntity):
             self._commands_encoding,
             self._controller_data,
             self._delay,
+            self._controller_options,
         )
 
     async def async_added_to_hass(self):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
+        register_entity(self.hass, self)
+        self.hass.async_create_task(
+            self._controller.async_prepare(self._commands))
 
         last_state = await self.async_get_last_state()
         if last_state is not None:
@@ -206,6 +186,13 @@ class SmartIRLight(LightEntity, RestoreEntity):
                 self.hass, self._power_sensor, self._async_power_sensor_changed
             )
 
+    async def async_will_remove_from_hass(self):
+        """Release the shared device profile and the prepared commands."""
+        await super().async_will_remove_from_hass()
+        unregister_entity(self.hass, self)
+        self._controller.release()
+        PROFILE_CACHE.release(self._profile)
+
     @property
     def unique_id(self):
         """Return a unique ID."""
@@ -358,13 +345,15 @@ class SmartIRLight(LightEntity, RestoreEntity):
             return
         _LOGGER.debug(f"Sending {cmd} remote command {count} times.")
         remote_cmd = self._commands.get(cmd)
-        async with self._temp_lock:
+        async with track_entity_send(self._send_stats, self._temp_lock) as timer:
             self._on_by_remote = False
             try:
-                for _ in range(count):
-                    await self._controller.send(remote_cmd)
+                await self._controller.send_repeated(
+                    remote_cmd, count, context=self._context
+                )
             except Exception as e:
                 _LOGGER.exception(e)
+                timer.error = True
 
     @callback
     async def _async_power_sensor_changed(self, event):
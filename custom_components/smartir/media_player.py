@@ -1,8 +1,5 @@
 import asyncio
-import aiofiles
-import json
 import logging
-import os.path
 
 import voluptuous as vol
 
@@ -14,22 +11,31 @@ from homeassistant.const import (
     CONF_NAME, STATE_OFF, STATE_ON, STATE_UNKNOWN)
 import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.restore_state import RestoreEntity
-from . import COMPONENT_ABS_DIR, Helper
-from .controller import get_controller
+from . import register_entity, unregister_entity
+from .controller import CONTROLLER_OPTIONS_SCHEMA, get_controller
+from .fingerprint import LastSentState, state_fingerprint
+from .profiles import PROFILE_CACHE, async_get_device_profile
+from .stats import SendStats, track_entity_send
+from .tracing import trace_setup, traced
 
 _LOGGER = logging.getLogger(__name__)
 
 DEFAULT_NAME = "SmartIR Media Player"
 DEFAULT_DEVICE_CLASS = "tv"
 DEFAULT_DELAY = 0.5
+DEFAULT_RESEND_WINDOW = 0.0
 
 CONF_UNIQUE_ID = 'unique_id'
 CONF_DEVICE_CODE = 'device_code'
 CONF_CONTROLLER_DATA = "controller_data"
 CONF_DELAY = "delay"
+CONF_CONTROLLER_OPTIONS = 'controller_options'
 CONF_POWER_SENSOR = 'power_sensor'
 CONF_SOURCE_NAMES = 'source_names'
 CONF_DEVICE_CLASS = 'device_class'
+CONF_CHANNEL_CONFIRM = 'channel_confirm'
+CONF_CHANNEL_DIGIT_DELAY = 'channel_digit_delay'
+CONF_RESEND_WINDOW = 'resend_window'
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_UNIQUE_ID): cv.string,
@@ -37,63 +43,49 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Required(CONF_DEVICE_CODE): cv.positive_int,
     vol.Required(CONF_CONTROLLER_DATA): cv.string,
     vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.string,
+    vol.Optional(CONF_CONTROLLER_OPTIONS, default={}): CONTROLLER_OPTIONS_SCHEMA,
     vol.Optional(CONF_POWER_SENSOR): cv.entity_id,
     vol.Optional(CONF_SOURCE_NAMES): dict,
-    vol.Optional(CONF_DEVICE_CLASS, default=DEFAULT_DEVICE_CLASS): cv.string
+    vol.Optional(CONF_DEVICE_CLASS, default=DEFAULT_DEVICE_CLASS): cv.string,
+    vol.Optional(CONF_CHANNEL_CONFIRM): cv.string,
+    vol.Optional(CONF_CHANNEL_DIGIT_DELAY): cv.positive_float,
+    vol.Optional(CONF_RESEND_WINDOW, default=DEFAULT_RESEND_WINDOW): cv.positive_float
 })
 
 async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the IR Media Player platform."""
     device_code = config.get(CONF_DEVICE_CODE)
-    device_files_subdir = os.path.join('codes', 'media_player')
-    device_files_absdir = os.path.join(COMPONENT_ABS_DIR, device_files_subdir)
-
-    if not os.path.isdir(device_files_absdir):
-        os.makedirs(device_files_absdir)
-
-    device_json_filename = str(device_code) + '.json'
-    device_json_path = os.path.join(device_files_absdir, device_json_filename)
-
-    if not os.path.exists(device_json_path):
-        _LOGGER.warning("Couldn't find the device Json file. The component will " \
-                        "try to download it from the GitHub repo.")
-
-        try:
-            codes_source = ("https://raw.githubusercontent.com/"
-                            "smartHomeHub/SmartIR/master/"
-                            "codes/media_player/{}.json")
-
-            await Helper.downloader(codes_source.format(device_code), device_json_path)
-        except Exception:
-            _LOGGER.error("There was an error while downloading the device Json file. " \
-                          "Please check your internet connection or if the device code " \
-                          "exists on GitHub. If the problem still exists please " \
-                          "place the file manually in the proper directory.")
+
+    with trace_setup(hass, 'media_player', device_code, config.get(CONF_NAME)):
+        profile = await async_get_device_profile(hass, 'media_player', device_code)
+
+        if profile is None:
             return
 
-    try:
-        async with aiofiles.open(device_json_path, mode='r') as j:
-            _LOGGER.debug(f"loading json file {device_json_path}")
-            content = await j.read()
-            device_data = json.loads(content)
-            _LOGGER.debug(f"{device_json_path} file loaded")
-    except Exception:
-        _LOGGER.error("The device JSON file is invalid")
-        return
+        with traced('build'):
+            try:
+                entity = SmartIRMediaPlayer(hass, config, profile)
+            except Exception:
+                # The profile would never be evicted otherwise
+                PROFILE_CACHE.release(profile)
+                raise
 
-    async_add_entities([SmartIRMediaPlayer(
-        hass, config, device_data
-    )])
+            async_add_entities([entity])
 
 class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
-    def __init__(self, hass, config, device_data):
+    def __init__(self, hass, config, profile):
+        device_data = profile.data
         self.hass = hass
+        self._profile = profile
         self._unique_id = config.get(CONF_UNIQUE_ID)
         self._name = config.get(CONF_NAME)
         self._device_code = config.get(CONF_DEVICE_CODE)
         self._controller_data = config.get(CONF_CONTROLLER_DATA)
         self._delay = config.get(CONF_DELAY)
+        self._controller_options = config.get(CONF_CONTROLLER_OPTIONS)
         self._power_sensor = config.get(CONF_POWER_SENSOR)
+        self._channel_digit_delay = config.get(CONF_CHANNEL_DIGIT_DELAY)
+        self._channel_confirm = None
 
         self._manufacturer = device_data['manufacturer']
         self._supported_models = device_data['supportedModels']
@@ -131,6 +123,11 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
         if 'sources' in self._commands and self._commands['sources'] is not None:
             self._support_flags = self._support_flags | MediaPlayerEntityFeature.SELECT_SOURCE | MediaPlayerEntityFeature.PLAY_MEDIA
 
+            #The device data is shared with other entities, copy before renaming
+            if config.get(CONF_SOURCE_NAMES):
+                self._commands = dict(self._commands)
+                self._commands['sources'] = dict(self._commands['sources'])
+
             for source, new_name in config.get(CONF_SOURCE_NAMES, {}).items():
                 if source in self._commands['sources']:
                     if new_name is not None:
@@ -142,7 +139,21 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
             for key in self._commands['sources']:
                 self._sources_list.append(key)
 
+        #Command sent after the digits of a channel
+        channel_confirm = config.get(CONF_CHANNEL_CONFIRM)
+        if channel_confirm is not None:
+            sources = self._commands.get('sources') or {}
+            if channel_confirm in sources:
+                self._channel_confirm = sources[channel_confirm]
+            elif self._commands.get(channel_confirm) is not None:
+                self._channel_confirm = self._commands[channel_confirm]
+            else:
+                _LOGGER.warning("The channel confirm command '%s' was not "
+                                "found in the device file", channel_confirm)
+
         self._temp_lock = asyncio.Lock()
+        self._send_stats = SendStats()
+        self._last_sent = LastSentState(config.get(CONF_RESEND_WINDOW))
 
         #Init the IR/RF controller
         self._controller = get_controller(
@@ -150,16 +161,28 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
             self._supported_controller, 
             self._commands_encoding,
             self._controller_data,
-            self._delay)
+            self._delay,
+            self._controller_options)
 
     async def async_added_to_hass(self):
         """Run when entity about to be added."""
         await super().async_added_to_hass()
+        register_entity(self.hass, self)
+        self.hass.async_create_task(
+            self._controller.async_prepare(self._commands))
 
         last_state = await self.async_get_last_state()
 
         if last_state is not None:
             self._state = last_state.state
+            self._last_sent.restore(last_state.attributes)
+
+    async def async_will_remove_from_hass(self):
+        """Release the shared device profile and the prepared commands."""
+        await super().async_will_remove_from_hass()
+        unregister_entity(self.hass, self)
+        self._controller.release()
+        PROFILE_CACHE.release(self._profile)
 
     @property
     def should_poll(self):
@@ -218,11 +241,13 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
             'supported_models': self._supported_models,
             'supported_controller': self._supported_controller,
             'commands_encoding': self._commands_encoding,
+            **self._last_sent.attributes
         }
 
     async def async_turn_off(self):
         """Turn the media player off."""
-        await self.send_command(self._commands['off'])
+        await self.send_command(
+            self._commands['off'], state_fingerprint(STATE_OFF))
         
         if self._power_sensor is None:
             self._state = STATE_OFF
@@ -231,7 +256,8 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
 
     async def async_turn_on(self):
         """Turn the media player off."""
-        await self.send_command(self._commands['on'])
+        await self.send_command(
+            self._commands['on'], state_fingerprint(STATE_ON))
 
         if self._power_sensor is None:
             self._state = STATE_ON
@@ -265,7 +291,8 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
     async def async_select_source(self, source):
         """Select channel from source."""
         self._source = source
-        await self.send_command(self._commands['sources'][source])
+        await self.send_command(
+            self._commands['sources'][source], state_fingerprint(source))
         self.async_write_ha_state()
 
     async def async_play_media(self, media_type, media_id, **kwargs):
@@ -281,16 +308,66 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
             return
 
         self._source = "Channel {}".format(media_id)
-        for digit in media_id:
-            await self.send_command(self._commands['sources']["Channel {}".format(digit)])
+        commands = [self._commands['sources']["Channel {}".format(digit)]
+                    for digit in media_id]
+
+        if self._channel_confirm is not None:
+            commands.append(self._channel_confirm)
+
+        await self.send_sequence(commands, self._channel_digit_delay)
         self.async_write_ha_state()
 
-    async def send_command(self, command):
-        async with self._temp_lock:
+    async def async_resend_state(self):
+        """Send the current state, even if it was just sent."""
+        if self._state == STATE_OFF:
+            await self.send_command(
+                self._commands['off'], state_fingerprint(STATE_OFF), True)
+            return
+
+        await self.send_command(
+            self._commands['on'], state_fingerprint(STATE_ON), True)
+
+        if self._source in self._sources_list:
+            await self.send_command(
+                self._commands['sources'][self._source],
+                state_fingerprint(self._source), True)
+
+    async def send_command(self, command, fingerprint=None, force=False):
+        """Send a command.
+
+        Commands setting a state pass its fingerprint and are skipped if
+        the same state was just sent. Other commands (e.g. volume steps)
+        are always sent.
+        """
+        async with track_entity_send(self._send_stats, self._temp_lock) as timer:
+            if (fingerprint is not None and not force and
+                    self._last_sent.is_redundant(fingerprint)):
+                _LOGGER.debug("%s: the state was just sent, skipping it",
+                              self._name)
+                return
+
             try:
-                await self._controller.send(command)
+                await self._controller.send(command, context=self._context)
             except Exception as e:
                 _LOGGER.exception(e)
+                timer.error = True
+                return
+
+            if fingerprint is None:
+                self._last_sent.invalidate()
+            else:
+                self._last_sent.record(fingerprint)
+
+    async def send_sequence(self, commands, delay=None):
+        async with track_entity_send(self._send_stats, self._temp_lock) as timer:
+            try:
+                await self._controller.send_sequence(
+                    commands, delay, context=self._context)
+            except Exception as e:
+                _LOGGER.exception(e)
+                timer.error = True
+
+            self._last_sent.invalidate()
             
     async def async_update(self):
         if self._power_sensor is None:
@@ -299,6 +376,13 @@ class SmartIRMediaPlayer(MediaPlayerEntity, RestoreEntity):
         power_state = self.hass.states.get(self._power_sensor)
 
         if power_state:
+            #The device was operated otherwise (e.g. by its own remote) if
+            #the sensor disagrees with the last state sent
+            if power_state.state in (STATE_OFF, STATE_ON) and \
+                    power_state.state != self._state and \
+                    state_fingerprint(power_state.state) != self._last_sent.fingerprint:
+                self._last_sent.invalidate()
+
             if power_state.state == STATE_OFF:
                 self._state = STATE_OFF
                 self._source = None
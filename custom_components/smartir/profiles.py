@@ -0,0 +1,654 @@
+"""Shared cache of SmartIR device profiles (the JSON device code files)."""
+import asyncio
+from collections import OrderedDict
+from collections.abc import Mapping
+import json
+import logging
+import mmap
+import os.path
+import re
+import sys
+
+import aiofiles
+
+from homeassistant.components import persistent_notification
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+
+from . import COMPONENT_ABS_DIR, DOMAIN, Helper
+from .codepack import CodePack, PackNode, pack_path
+from .tracing import traced
+
+_LOGGER = logging.getLogger(__name__)
+
+CODES_SOURCE = ("https://raw.githubusercontent.com/"
+                "smartHomeHub/SmartIR/master/"
+                "codes/{}/{}.json")
+
+MAX_UNUSED_PROFILES = 8
+
+PREFETCHES = 'prefetches'
+PREFETCH_CONCURRENCY = 4
+PREFETCH_ATTEMPTS = 3
+PREFETCH_RETRY_DELAY = 2
+
+_WHITESPACE = re.compile(rb'[ \t\n\r]*')
+_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+_STRUCTURE = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|([\[{])|([\]}])', re.S)
+_SCALAR = re.compile(rb'[^,}\]\s]+')
+
+
+class DeviceProfile:
+    """A parsed device file, shared read-only by every entity using it."""
+
+    def __init__(self, platform, device_code, path, mtime, size, data, payloads):
+        self.platform = platform
+        self.device_code = device_code
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.payloads = payloads
+        self.refcount = 0
+
+    async def async_ensure_loaded(self, hass, *path):
+        """Make sure the commands under path are held in memory."""
+        commands = self.data['commands']
+
+        if isinstance(commands, LazyCommands):
+            await commands.async_ensure_loaded(hass, *path)
+
+    @property
+    def key(self):
+        """Return the cache key of the profile."""
+        return (self.platform, self.device_code)
+
+    def is_stale(self, stat):
+        """Return True if the file on disk changed since it was loaded."""
+        return (self.mtime, self.size) != _signature(stat)
+
+    def memory_usage(self, seen):
+        """Return the memory held by the profile.
+
+        seen is the set of the ids of the objects already accounted for, it
+        is updated with the objects of the profile.
+        """
+        commands = self.data['commands']
+        usage = {
+            'file_size': self.size,
+            'deep_size': deep_sizeof(self.data, seen) +
+                         deep_sizeof(self.payloads._payloads, seen),
+            'unique_payloads': self.payloads.unique,
+            'total_payloads': self.payloads.total,
+            'dedup_ratio': round(self.payloads.dedup_ratio, 3),
+            'entities': self.refcount,
+        }
+
+        if isinstance(commands, PackNode):
+            usage['loader'] = 'pack'
+            usage['mapped_size'] = commands.pack.mapped_size
+        elif isinstance(commands, LazyCommands):
+            usage['loader'] = 'lazy'
+        else:
+            usage['loader'] = 'json'
+
+        return usage
+
+
+class ProfileCache:
+    """Reference-counted cache of device profiles.
+
+    Profiles are keyed by (platform, device_code) and shared between all the
+    entities using the same device file. A profile is reloaded when the file
+    modification time or size changes. Profiles no longer used by any entity
+    are kept around until more than `max_unused` of them pile up, in which
+    case the least recently released ones are evicted.
+
+    The returned data must be treated as read-only. Entities that need to
+    modify it must copy the parts they change.
+    """
+
+    def __init__(self, max_unused=MAX_UNUSED_PROFILES):
+        self._profiles = {}
+        self._unused = OrderedDict()
+        self._locks = {}
+        self._max_unused = max_unused
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def profiles(self):
+        """Return the currently cached profiles."""
+        return list(self._profiles.values())
+
+    async def async_acquire(self, hass, platform, device_code, path, lazy=False):
+        """Return the profile of a device file, loading it if needed.
+
+        With lazy set, only the header fields are parsed and the
+        commands[mode][fan] subtrees are read from the file on first use.
+        """
+        key = (platform, device_code)
+        lock = self._locks.setdefault(key, asyncio.Lock())
+
+        async with lock:
+            stat = os.stat(path)
+            profile = self._profiles.get(key)
+
+            if profile is not None and profile.is_stale(stat):
+                _LOGGER.debug("%s changed on disk, reloading it", path)
+                self._discard(key)
+                profile = None
+
+            if profile is None:
+                profile = await self._async_load(
+                    hass, platform, device_code, path, stat, lazy)
+                self._profiles[key] = profile
+
+            self._unused.pop(key, None)
+            profile.refcount += 1
+            return profile
+
+    def release(self, profile):
+        """Release a profile previously returned by async_acquire."""
+        profile.refcount -= 1
+
+        if profile.refcount > 0 or self._profiles.get(profile.key) is not profile:
+            return
+
+        self._unused[profile.key] = profile
+
+        while len(self._unused) > self._max_unused:
+            key, _ = self._unused.popitem(last=False)
+            _LOGGER.debug("Evicting unused device profile %s/%s", *key)
+            del self._profiles[key]
+
+    def _discard(self, key):
+        """Forget a profile. Entities still holding it keep their copy."""
+        self._profiles.pop(key, None)
+        self._unused.pop(key, None)
+
+    async def _async_load(self, hass, platform, device_code, path, stat, lazy):
+        payloads = PayloadTable()
+        with traced('read'):
+            data = await hass.async_add_executor_job(
+                _load_pack, path, stat, payloads)
+
+        if data is not None:
+            _LOGGER.debug(f"{path} loaded from its compiled pack")
+        elif lazy:
+            with traced('parse'):
+                data = await hass.async_add_executor_job(_scan_lazy, path, payloads)
+            _LOGGER.debug(f"{path} file indexed")
+        else:
+            with traced('read'):
+                async with aiofiles.open(path, mode='r') as j:
+                    _LOGGER.debug(f"loading json file {path}")
+                    content = await j.read()
+
+            with traced('parse'):
+                data = await hass.async_add_executor_job(
+                    _parse_json, content, payloads)
+            _LOGGER.debug(f"{path} file loaded")
+
+        _LOGGER.debug("%s: %d unique payloads out of %d loaded (%.1f%% deduplicated)",
+                      path, payloads.unique, payloads.total,
+                      payloads.dedup_ratio * 100)
+
+        return DeviceProfile(
+            platform, device_code, path, stat.st_mtime_ns, stat.st_size,
+            data, payloads)
+
+
+class PayloadTable:
+    """Table of the unique command payloads of a profile.
+
+    Identical payloads found in a device file are replaced by a single
+    shared string, so memory grows with the number of unique codes rather
+    than with the number of mode/fan/swing/temperature combinations.
+    """
+
+    def __init__(self):
+        self._payloads = {}
+        self.unique = 0
+        self.total = 0
+
+    @property
+    def dedup_ratio(self):
+        """Return the fraction of payloads that were duplicates."""
+        if not self.total:
+            return 0.0
+        return 1 - self.unique / self.total
+
+    def intern(self, value):
+        """Return the shared instance of the payloads found in value.
+
+        Dicts and lists are updated in place.
+        """
+        if isinstance(value, str):
+            self.total += 1
+            payload = self._payloads.get(value)
+            if payload is None:
+                self._payloads[value] = payload = value
+                self.unique += 1
+            return payload
+
+        if isinstance(value, dict):
+            for key, item in value.items():
+                value[key] = self.intern(item)
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                value[index] = self.intern(item)
+
+        return value
+
+
+class DeviceFileChanged(Exception):
+    """The device file changed since its command subtrees were indexed."""
+
+
+class CommandsNotLoaded(Exception):
+    """A command subtree was read before async_ensure_loaded loaded it."""
+
+
+class LazyCommands(Mapping):
+    """Commands of a device file whose mode subtrees are loaded on demand.
+
+    Top level commands that are not objects (e.g. 'on' and 'off') are held
+    in memory, while for objects only the location of each
+    commands[mode][fan] value in the file is kept until it is needed.
+
+    The locations are only valid for the file as it was indexed, its
+    modification time and size are checked before every read. Subtrees
+    are read in the executor by async_ensure_loaded, reading one that is
+    not loaded yet raises CommandsNotLoaded rather than blocking the
+    event loop.
+    """
+
+    def __init__(self, path, signature, commands, spans, payloads):
+        self._path = path
+        self._signature = signature
+        self._payloads = payloads
+        self._commands = commands
+        self._modes = {mode: _LazyMode(self, fans)
+                       for mode, fans in spans.items()}
+
+    def __getitem__(self, key):
+        if key in self._modes:
+            return self._modes[key]
+        return self._commands[key]
+
+    def __iter__(self):
+        yield from self._commands
+        yield from self._modes
+
+    def __len__(self):
+        return len(self._commands) + len(self._modes)
+
+    async def async_ensure_loaded(self, hass, mode=None, fan=None, *_):
+        """Load the commands[mode][fan] subtree in the executor."""
+        lazy_mode = self._modes.get(mode)
+
+        if lazy_mode is None or not lazy_mode.is_pending(fan):
+            return
+
+        try:
+            value = await hass.async_add_executor_job(
+                self.read_span, lazy_mode.spans[fan])
+        except DeviceFileChanged:
+            _LOGGER.warning("%s changed on disk, indexing it again. Restart "
+                            "Home Assistant to apply changes to other fields "
+                            "than commands", self._path)
+            await self._async_reindex(hass)
+            await self.async_ensure_loaded(hass, mode, fan)
+            return
+
+        lazy_mode.loaded.setdefault(fan, value)
+
+    async def async_load_all(self, hass):
+        """Load every subtree, e.g. before walking the whole tree."""
+        for mode, lazy_mode in list(self._modes.items()):
+            for fan in list(lazy_mode.spans):
+                await self.async_ensure_loaded(hass, mode, fan)
+
+    async def _async_reindex(self, hass):
+        """Index the command subtrees of the device file again."""
+        data = await hass.async_add_executor_job(
+            _scan_lazy, self._path, self._payloads)
+        other = data['commands']
+
+        self._signature = other._signature
+        self._commands = other._commands
+        self._modes = {mode: _LazyMode(self, lazy_mode.spans)
+                       for mode, lazy_mode in other._modes.items()}
+
+    def read_span(self, span):
+        """Read and parse a value from the device file.
+
+        Raises DeviceFileChanged rather than reading at an offset of a
+        file that changed since it was indexed.
+        """
+        start, end = span
+
+        with open(self._path, 'rb') as f:
+            if _signature(os.fstat(f.fileno())) != self._signature:
+                raise DeviceFileChanged(
+                    "{} changed on disk since it was loaded".format(self._path))
+            f.seek(start)
+            return self._payloads.intern(json.loads(f.read(end - start)))
+
+
+class _LazyMode(Mapping):
+    """The fan mode subtrees of a single operation mode."""
+
+    def __init__(self, commands, spans):
+        self._commands = commands
+        self.spans = spans
+        self.loaded = {}
+
+    def is_pending(self, fan):
+        """Return True if the subtree exists but is not loaded yet."""
+        return fan in self.spans and fan not in self.loaded
+
+    def __getitem__(self, fan):
+        if self.is_pending(fan):
+            raise CommandsNotLoaded(
+                "The commands of fan mode {} are not loaded yet, see "
+                "async_ensure_loaded".format(fan))
+        return self.loaded[fan]
+
+    def __contains__(self, fan):
+        return fan in self.spans
+
+    def __iter__(self):
+        return iter(self.spans)
+
+    def __len__(self):
+        return len(self.spans)
+
+
+def deep_sizeof(obj, seen):
+    """Return the size of obj and of the objects it references, once each.
+
+    Lazily loaded commands only count the parts loaded so far, and packs
+    only their header since the commands stay in the memory-mapped file.
+    """
+    size = 0
+    stack = [obj]
+
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif isinstance(obj, LazyCommands):
+            stack.extend((obj._commands, obj._modes))
+        elif isinstance(obj, _LazyMode):
+            stack.extend((obj.spans, obj.loaded))
+
+    return size
+
+
+def _parse_json(content, payloads):
+    """Parse a device file and intern its command payloads."""
+    data = json.loads(content)
+    payloads.intern(data['commands'])
+    return data
+
+
+def _load_pack(path, stat, payloads):
+    """Return the device data of a fresh compiled pack of path, if any."""
+    try:
+        pack = CodePack(pack_path(path))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        _LOGGER.warning("Ignoring the compiled pack of %s: %s", path, e)
+        return None
+
+    if not pack.is_fresh(stat):
+        _LOGGER.debug("The compiled pack of %s is outdated", path)
+        return None
+
+    # Packs store every unique payload once already
+    payloads.unique = pack.unique_payloads()
+    payloads.total = len(pack)
+
+    data = dict(pack.info)
+    data['commands'] = pack.commands
+    return data
+
+
+def _skip_whitespace(buf, pos):
+    return _WHITESPACE.match(buf, pos).end()
+
+
+def _skip_value(buf, pos):
+    """Return the position right after the JSON value starting at pos."""
+    char = buf[pos:pos + 1]
+
+    if char == b'"':
+        match = _STRING.match(buf, pos)
+    elif char in (b'{', b'['):
+        depth = 0
+        for match in _STRUCTURE.finditer(buf, pos):
+            if match.lastindex == 1:
+                depth += 1
+            elif match.lastindex == 2:
+                depth -= 1
+                if depth == 0:
+                    return match.end()
+        raise ValueError("Unterminated JSON value at {}".format(pos))
+    else:
+        match = _SCALAR.match(buf, pos)
+
+    if match is None:
+        raise ValueError("Invalid JSON value at {}".format(pos))
+    return match.end()
+
+
+def _scan_object(buf, pos, member):
+    """Scan the JSON object at pos and return the position right after it.
+
+    member(key, start) is called for each member with the position of its
+    value and must return the position right after that value.
+    """
+    if buf[pos:pos + 1] != b'{':
+        raise ValueError("Expected a JSON object at {}".format(pos))
+
+    pos = _skip_whitespace(buf, pos + 1)
+    if buf[pos:pos + 1] == b'}':
+        return pos + 1
+
+    while True:
+        match = _STRING.match(buf, pos)
+        if match is None:
+            raise ValueError("Expected a property name at {}".format(pos))
+        key = json.loads(match.group())
+
+        pos = _skip_whitespace(buf, match.end())
+        if buf[pos:pos + 1] != b':':
+            raise ValueError("Expected ':' at {}".format(pos))
+
+        pos = member(key, _skip_whitespace(buf, pos + 1))
+
+        pos = _skip_whitespace(buf, pos)
+        char = buf[pos:pos + 1]
+        if char == b'}':
+            return pos + 1
+        if char != b',':
+            raise ValueError("Expected ',' or '}}' at {}".format(pos))
+        pos = _skip_whitespace(buf, pos + 1)
+
+
+def _signature(stat):
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _scan_lazy(path, payloads):
+    """Parse the header of a device file and index its command subtrees.
+
+    The file is scanned once through a memory map, so only the header values
+    and the top level scalar commands are ever copied into memory.
+    """
+    data = {}
+    commands = {}
+    spans = {}
+
+    with open(path, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        signature = _signature(os.fstat(f.fileno()))
+
+        def load(start):
+            end = _skip_value(buf, start)
+            return json.loads(buf[start:end]), end
+
+        def fan_member(fans, fan, start):
+            end = _skip_value(buf, start)
+            fans[fan] = (start, end)
+            return end
+
+        def mode_member(mode, start):
+            if buf[start:start + 1] != b'{':
+                commands[mode], end = load(start)
+                payloads.intern(commands[mode])
+                return end
+
+            fans = spans[mode] = {}
+            return _scan_object(
+                buf, start, lambda fan, pos: fan_member(fans, fan, pos))
+
+        def root_member(key, start):
+            if key == 'commands':
+                return _scan_object(buf, start, mode_member)
+
+            data[key], end = load(start)
+            return end
+
+        _scan_object(buf, _skip_whitespace(buf, 0), root_member)
+
+    data['commands'] = LazyCommands(path, signature, commands, spans, payloads)
+    return data
+
+
+PROFILE_CACHE = ProfileCache()
+
+
+def device_file_path(platform, device_code):
+    """Return the path of the JSON file of a device."""
+    return os.path.join(
+        COMPONENT_ABS_DIR, 'codes', platform, str(device_code) + '.json')
+
+
+async def _async_download_device_file(session, semaphore, platform, device_code):
+    """Download a device file, retrying on failure. Return True on success."""
+    path = device_file_path(platform, device_code)
+
+    async with semaphore:
+        for attempt in range(1, PREFETCH_ATTEMPTS + 1):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                await Helper.downloader(
+                    CODES_SOURCE.format(platform, device_code), path, session)
+                return True
+            except Exception as e:
+                _LOGGER.debug("Attempt %d to download %s device %s failed: %s",
+                              attempt, platform, device_code, e)
+                if attempt < PREFETCH_ATTEMPTS:
+                    await asyncio.sleep(PREFETCH_RETRY_DELAY * attempt)
+
+    return False
+
+
+def prefetch_device_files(hass, devices):
+    """Start downloading the missing files of the (platform, device_code) devices.
+
+    The files are downloaded concurrently, in the background. Platforms
+    setting up a device wait for its download through
+    async_get_device_profile. All the failures are reported at once.
+    """
+    prefetches = hass.data.setdefault(DOMAIN, {}).setdefault(PREFETCHES, {})
+    session = async_get_clientsession(hass)
+    semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+    for device in set(devices):
+        if device in prefetches or os.path.exists(device_file_path(*device)):
+            continue
+
+        prefetches[device] = hass.async_create_task(
+            _async_download_device_file(session, semaphore, *device))
+
+    if not prefetches:
+        return
+
+    _LOGGER.info("Downloading %d missing device files", len(prefetches))
+
+    async def _async_report():
+        devices = list(prefetches)
+        results = await asyncio.gather(*prefetches.values())
+        failed = sorted("{} {}".format(*device)
+                        for device, result in zip(devices, results) if not result)
+
+        if failed:
+            _LOGGER.error("Couldn't download the device files of: %s",
+                          ", ".join(failed))
+            persistent_notification.async_create(
+                hass,
+                "The device Json files of the following devices could not be "
+                "downloaded from the GitHub repo: {}. Please check your internet "
+                "connection or if the device codes exist on GitHub. If the problem "
+                "still exists please place the files manually in the proper "
+                "directory.".format(", ".join(failed)),
+                title='SmartIR')
+
+    hass.async_create_task(_async_report())
+
+
+async def async_get_device_profile(hass, platform, device_code, lazy=False):
+    """Return the shared profile of a device, downloading it if missing.
+
+    Returns None if the device file could not be downloaded or parsed.
+    """
+    device_json_path = device_file_path(platform, device_code)
+    prefetch = hass.data.get(DOMAIN, {}).get(PREFETCHES, {}).get(
+        (platform, device_code))
+
+    if prefetch is not None:
+        with traced('prefetch'):
+            downloaded = await prefetch
+        if not downloaded:
+            # Already reported along with the other failed downloads
+            return None
+
+    with traced('check'):
+        exists = os.path.exists(device_json_path)
+
+    if not exists:
+        os.makedirs(os.path.dirname(device_json_path), exist_ok=True)
+        _LOGGER.warning("Couldn't find the device Json file. The component will " \
+                        "try to download it from the GitHub repo.")
+
+        try:
+            with traced('download'):
+                await Helper.downloader(
+                    CODES_SOURCE.format(platform, device_code), device_json_path)
+        except Exception:
+            _LOGGER.error("There was an error while downloading the device Json file. " \
+                          "Please check your internet connection or if the device code " \
+                          "exists on GitHub. If the problem still exists please " \
+                          "place the file manually in the proper directory.")
+            return None
+
+    try:
+        return await PROFILE_CACHE.async_acquire(
+            hass, platform, device_code, device_json_path, lazy)
+    except Exception as e:
+        _LOGGER.error("The device JSON file %s is invalid: %s. Check the device "
+                      "files with validator.py", device_json_path, e)
+        return None
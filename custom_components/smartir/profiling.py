@@ -0,0 +1,142 @@
+"""Profile SmartIR in place, on demand.
+
+Nothing is installed until a profiling session is started, so there is no
+overhead the rest of the time. Two modes are supported:
+
+    cprofile   deterministic profile of the event loop thread, written as
+               a pstats file (e.g. for snakeviz or `python -m pstats`)
+    sample     stacks of the event loop thread sampled from another
+               thread, written as collapsed stacks (e.g. for flamegraph.pl
+               or speedscope). Only the samples with SmartIR frames are
+               kept.
+
+The send path, the entity send_command methods and the platform setup all
+run in the event loop thread.
+"""
+import asyncio
+from collections import Counter
+import cProfile
+import io
+import logging
+import os.path
+import pstats
+import re
+import sys
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLE = 'sample'
+
+MODES = [MODE_CPROFILE, MODE_SAMPLE]
+
+SAMPLE_INTERVAL = 0.005
+TOP_FUNCTIONS = 20
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_session = None
+
+
+class _Sampler(threading.Thread):
+    """Sample the stacks of a thread until stopped."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='smartir_profiler', daemon=True)
+        self._thread_id = thread_id
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.samples = 0
+        self.stacks = Counter()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+
+            self.samples += 1
+            stack = []
+            smartir = False
+            while frame is not None:
+                code = frame.f_code
+                smartir = smartir or code.co_filename.startswith(PACKAGE_DIR)
+                stack.append('{} ({}:{})'.format(
+                    code.co_name, os.path.basename(code.co_filename),
+                    code.co_firstlineno))
+                frame = frame.f_back
+
+            if smartir:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _write_pstats(profiler, path):
+    profiler.dump_stats(path)
+
+    output = io.StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE)
+    stats.print_stats(re.escape(PACKAGE_DIR), TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+def _write_collapsed(stacks, path):
+    with open(path, 'w') as f:
+        for stack, count in stacks.most_common():
+            f.write('{} {}\n'.format(stack, count))
+
+
+async def async_profile(hass, mode, duration):
+    """Profile the event loop thread for duration seconds.
+
+    Return the path of the written file and a summary of the profile.
+    """
+    global _session
+
+    if _session is not None:
+        raise Exception("A profiling session is already running, it ends in "
+                        "{:.0f}s".format(_session - time.monotonic()))
+
+    start = time.strftime('%Y%m%d-%H%M%S')
+    _session = time.monotonic() + duration
+
+    try:
+        if mode == MODE_CPROFILE:
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                profiler.disable()
+
+            path = hass.config.path('smartir_profile.{}.pstats'.format(start))
+            top = await hass.async_add_executor_job(
+                _write_pstats, profiler, path)
+            result = {'path': path, 'top': top}
+        else:
+            sampler = _Sampler(threading.get_ident(), SAMPLE_INTERVAL)
+            sampler.start()
+            try:
+                await asyncio.sleep(duration)
+            finally:
+                await hass.async_add_executor_job(sampler.stop)
+
+            path = hass.config.path('smartir_profile.{}.collapsed'.format(start))
+            await hass.async_add_executor_job(
+                _write_collapsed, sampler.stacks, path)
+            result = {
+                'path': path,
+                'samples': sampler.samples,
+                'smartir_samples': sum(sampler.stacks.values()),
+            }
+    finally:
+        _session = None
+
+    _LOGGER.info("SmartIR profile written to %s", path)
+    return result
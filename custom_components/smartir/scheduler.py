@@ -0,0 +1,122 @@
+"""Per-hub transmit scheduling shared by all the SmartIR entities."""
+import asyncio
+import heapq
+import itertools
+import logging
+
+from . import (
+    CONF_TRANSMIT_QUEUE_SIZE, CONF_TRANSMIT_SPACING, DEFAULT_TRANSMIT_QUEUE_SIZE,
+    DEFAULT_TRANSMIT_SPACING, DOMAIN)
+from .stats import timed
+
+_LOGGER = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AUTOMATION = 1
+
+SCHEDULERS = 'schedulers'
+
+
+class TransmitQueueFull(Exception):
+    """Raised when too many transmissions are waiting for a hub."""
+
+
+def priority_from_context(context):
+    """Return the priority of a transmission requested within context.
+
+    Service calls made by a user (e.g. from the UI) carry a user id, while
+    the ones made by automations and scripts do not.
+    """
+    if context is not None and context.user_id is not None:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_AUTOMATION
+
+
+def hub_name(key):
+    """Return the display name of a hub key, e.g. 'Broadlink remote.bedroom'."""
+    return ' '.join(str(part) for part in key)
+
+
+def get_scheduler(hass, controller, controller_data):
+    """Return the scheduler of the hub identified by its controller data."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+    schedulers = domain_data.setdefault(SCHEDULERS, {})
+    key = (controller, controller_data)
+
+    if key not in schedulers:
+        schedulers[key] = TransmitScheduler(
+            key,
+            domain_data.get(CONF_TRANSMIT_SPACING, DEFAULT_TRANSMIT_SPACING),
+            domain_data.get(CONF_TRANSMIT_QUEUE_SIZE, DEFAULT_TRANSMIT_QUEUE_SIZE))
+
+    return schedulers[key]
+
+
+class TransmitScheduler:
+    """Single ordered transmit queue of a hub.
+
+    Transmissions run one at a time, at least `spacing` seconds apart.
+    Waiting transmissions are served by priority, then in order of
+    arrival. At most `max_queue` transmissions can wait at once.
+    """
+
+    def __init__(self, key, spacing, max_queue):
+        self.key = key
+        self._spacing = spacing
+        self._max_queue = max_queue
+        self._waiters = []
+        self._counter = itertools.count()
+        self._busy = False
+        self._last_end = None
+
+    @property
+    def queue_depth(self):
+        """Return the number of transmissions waiting for the hub."""
+        return sum(1 for *_, waiter in self._waiters if not waiter.done())
+
+    async def async_run(self, job, priority=PRIORITY_AUTOMATION):
+        """Run the transmit coroutine function job when the hub is free."""
+        with timed('queue'):
+            await self._async_acquire(priority)
+
+        try:
+            if self._spacing and self._last_end is not None:
+                wait = self._last_end + self._spacing - asyncio.get_running_loop().time()
+                if wait > 0:
+                    with timed('sleep'):
+                        await asyncio.sleep(wait)
+
+            return await job()
+        finally:
+            self._last_end = asyncio.get_running_loop().time()
+            self._release()
+
+    async def _async_acquire(self, priority):
+        if not self._busy and not self._waiters:
+            self._busy = True
+            return
+
+        if self.queue_depth >= self._max_queue:
+            raise TransmitQueueFull(
+                "Too many transmissions waiting for {} {}".format(*self.key))
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # The hub was handed over right before the cancellation
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            raise
+
+    def _release(self):
+        """Hand the hub over to the next waiting transmission."""
+        while self._waiters:
+            *_, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self._busy = False
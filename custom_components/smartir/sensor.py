@@ -0,0 +1,65 @@
+import logging
+
+from homeassistant.components.sensor import (
+    PLATFORM_SCHEMA, SensorDeviceClass, SensorEntity, SensorStateClass)
+from homeassistant.const import UnitOfTime
+from homeassistant.core import callback
+from .scheduler import SCHEDULERS, hub_name
+from .stats import HUB_STATS_LISTENER, STATS
+from . import DOMAIN
+
+_LOGGER = logging.getLogger(__name__)
+
+PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({})
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Set up a latency sensor for every hub, current and future."""
+    domain_data = hass.data.setdefault(DOMAIN, {})
+
+    @callback
+    def _add_hub(key, stats):
+        async_add_entities([SmartIRHubSensor(hass, key, stats)])
+
+    domain_data[HUB_STATS_LISTENER] = _add_hub
+
+    for key, stats in list(domain_data.get(STATS, {}).get('hubs', {}).items()):
+        _add_hub(key, stats)
+
+def _to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+class SmartIRHubSensor(SensorEntity):
+    """Transmission latency (95th percentile) of a hub."""
+
+    _attr_device_class = SensorDeviceClass.DURATION
+    _attr_state_class = SensorStateClass.MEASUREMENT
+    _attr_native_unit_of_measurement = UnitOfTime.MILLISECONDS
+
+    def __init__(self, hass, key, stats):
+        self.hass = hass
+        self._key = key
+        self._stats = stats
+        self._attr_name = "SmartIR {} latency".format(hub_name(key))
+        self._attr_unique_id = "smartir_latency_{}".format(
+            "_".join(str(part) for part in key))
+
+    @property
+    def native_value(self):
+        """Return the 95th percentile of the transmission latency."""
+        return _to_ms(self._stats.phases['total'].percentile(95))
+
+    @property
+    def extra_state_attributes(self):
+        """Return the latency percentiles, rate and errors of the hub."""
+        total = self._stats.phases['total']
+        scheduler = self.hass.data[DOMAIN].get(SCHEDULERS, {}).get(self._key)
+
+        return {
+            'p50': _to_ms(total.percentile(50)),
+            'p95': _to_ms(total.percentile(95)),
+            'p99': _to_ms(total.percentile(99)),
+            'sends': total.count,
+            'sends_per_minute': self._stats.sends_per_minute,
+            'errors': self._stats.errors,
+            'queue_depth': scheduler.queue_depth if scheduler else 0,
+        }
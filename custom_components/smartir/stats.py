@@ -0,0 +1,250 @@
+"""Latency statistics of the transmissions, per entity and per hub.
+
+A transmission is timed by a SendTimer made current for its task. The
+code along the send path adds the time it spends in each phase:
+
+    lock      waiting for the entity lock
+    queue     waiting for the hub scheduler
+    convert   converting or decoding the commands
+    call      calling the controller service (or the LOOKin HTTP API)
+    sleep     delays between commands and transmit spacing
+    total     the whole transmission
+
+Timings are kept in fixed bucket histograms, so recording a transmission
+costs a few list updates whatever the number of transmissions.
+"""
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from time import monotonic, perf_counter
+
+from . import DOMAIN
+
+STATS = 'stats'
+HUB_STATS_LISTENER = 'hub_stats_listener'
+
+PHASES = ['lock', 'queue', 'convert', 'call', 'sleep', 'total']
+
+# Upper bounds of the histogram buckets, in seconds: 0.5ms to about 55s,
+# each 25% wider than the previous one
+BUCKETS = [0.0005 * 1.25 ** index for index in range(53)]
+
+SENDS_WINDOW = 60
+
+_current_timer = ContextVar('smartir_send_timer', default=None)
+
+
+class LatencyHistogram:
+    """Histogram of durations over BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Return the q-th percentile, within 25% of the actual value."""
+        if not self.count:
+            return None
+
+        rank = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                break
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class SendStats:
+    """Latency histograms per phase and error count of a hub or an entity."""
+
+    def __init__(self):
+        self.phases = {phase: LatencyHistogram() for phase in PHASES}
+        self.errors = 0
+        self._recent = deque()
+
+    def record(self, timer):
+        for phase, seconds in timer.timings.items():
+            self.phases[phase].record(seconds)
+
+        if timer.error:
+            self.errors += 1
+
+        now = monotonic()
+        self._recent.append(now)
+        self._prune(now)
+
+    def _prune(self, now):
+        while self._recent and self._recent[0] < now - SENDS_WINDOW:
+            self._recent.popleft()
+
+    @property
+    def sends_per_minute(self):
+        self._prune(monotonic())
+        return len(self._recent) * 60 / SENDS_WINDOW
+
+    def as_dict(self):
+        return {
+            'sends_per_minute': self.sends_per_minute,
+            'errors': self.errors,
+            'phases': {phase: histogram.as_dict()
+                       for phase, histogram in self.phases.items()
+                       if histogram.count},
+        }
+
+
+class PhaseTimer:
+    """Time spent in each phase, of a transmission or of a setup."""
+
+    __slots__ = ('timings', 'start', 'end')
+
+    def __init__(self):
+        self.timings = {}
+        self.start = perf_counter()
+        self.end = None
+
+    def add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0.0) + seconds
+
+    def stop(self):
+        self.end = perf_counter()
+        self.timings['total'] = self.end - self.start
+
+
+class SendTimer(PhaseTimer):
+    """Time spent by a transmission in each phase."""
+
+    __slots__ = ('error', 'sends')
+
+    def __init__(self):
+        super().__init__()
+        self.error = False
+        self.sends = 0
+
+    def merge(self, timer):
+        """Add the timings of a nested timer."""
+        for phase, seconds in timer.timings.items():
+            if phase != 'total':
+                self.add(phase, seconds)
+        self.error = self.error or timer.error
+        self.sends += 1
+
+
+# The context managers below are plain classes rather than generators, they
+# run several times per transmission.
+
+class phase:
+    """Add the time spent in the block to the PhaseTimer current in var, if any."""
+
+    __slots__ = ('_name', '_var', '_timer', '_start')
+
+    def __init__(self, name, var):
+        self._name = name
+        self._var = var
+
+    def __enter__(self):
+        self._timer = self._var.get()
+        self._start = perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self._timer is not None:
+            self._timer.add(self._name, perf_counter() - self._start)
+
+
+def timed(name):
+    """Add the time spent in the block to the current transmission, if any."""
+    return phase(name, _current_timer)
+
+
+class track:
+    """Time the transmission made in the block and record it into stats."""
+
+    __slots__ = ('_stats', '_outer', '_timer', '_token')
+
+    def __init__(self, stats):
+        self._stats = stats
+
+    def __enter__(self):
+        self._outer = _current_timer.get()
+        self._timer = SendTimer()
+        self._token = _current_timer.set(self._timer)
+        return self._timer
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timer = self._timer
+        _current_timer.reset(self._token)
+
+        if exc_type is not None:
+            timer.error = True
+        timer.stop()
+        self._stats.record(timer)
+
+        if self._outer is not None:
+            self._outer.merge(timer)
+
+
+class track_entity_send:
+    """Acquire an entity lock and time the transmissions made meanwhile.
+
+    Nothing is recorded if no transmission was made, e.g. when it was
+    skipped as redundant, unless the entity flagged the timer with an
+    error it handled itself.
+    """
+
+    __slots__ = ('_stats', '_lock', '_timer', '_token')
+
+    def __init__(self, stats, lock):
+        self._stats = stats
+        self._lock = lock
+
+    async def __aenter__(self):
+        timer = self._timer = SendTimer()
+        start = perf_counter()
+        await self._lock.acquire()
+        timer.add('lock', perf_counter() - start)
+        self._token = _current_timer.set(timer)
+        return timer
+
+    async def __aexit__(self, *exc_info):
+        _current_timer.reset(self._token)
+        self._lock.release()
+
+        if self._timer.sends or self._timer.error:
+            self._timer.stop()
+            self._stats.record(self._timer)
+
+
+def get_stats(hass, kind, key):
+    """Return the statistics of a hub or an entity, creating them if needed."""
+    all_stats = hass.data.setdefault(DOMAIN, {}).setdefault(STATS, {})
+    stats = all_stats.setdefault(kind, {})
+
+    if key not in stats:
+        stats[key] = SendStats()
+
+        listener = hass.data[DOMAIN].get(HUB_STATS_LISTENER)
+        if kind == 'hubs' and listener is not None:
+            listener(key, stats[key])
+
+    return stats[key]
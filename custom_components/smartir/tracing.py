@@ -0,0 +1,144 @@
+"""Timings of the platform setup, per entity.
+
+The setup of an entity is traced by a SetupTrace made current for its
+task. The setup code adds the time it spends in each phase:
+
+    prefetch  waiting for the device file downloaded at startup
+    check     checking the device file exists
+    download  downloading a missing device file
+    read      reading the device file, or mapping its compiled pack
+    parse     parsing or indexing the device file
+    build     creating the entity
+    total     the whole setup
+
+Phases are skipped when a profile is already cached. The traces are kept
+in hass.data for the setup report.
+"""
+from contextvars import ContextVar
+import logging
+
+from . import DOMAIN
+from .stats import PhaseTimer, phase
+
+_LOGGER = logging.getLogger(__name__)
+
+SETUP_TRACES = 'setup_traces'
+
+SETUP_PHASES = ['prefetch', 'check', 'download', 'read', 'parse', 'build']
+
+SLOWEST_DEVICES = 10
+
+_current_trace = ContextVar('smartir_setup_trace', default=None)
+
+
+class SetupTrace(PhaseTimer):
+    """Time spent by the setup of an entity in each phase."""
+
+    __slots__ = ('platform', 'device_code', 'name')
+
+    def __init__(self, platform, device_code, name):
+        super().__init__()
+        self.platform = platform
+        self.device_code = device_code
+        self.name = name
+
+
+def traced(name):
+    """Add the time spent in the block to the current setup trace, if any."""
+    return phase(name, _current_trace)
+
+
+class trace_setup:
+    """Trace the setup of an entity made in the block."""
+
+    __slots__ = ('_hass', '_trace', '_token')
+
+    def __init__(self, hass, platform, device_code, name):
+        self._hass = hass
+        self._trace = SetupTrace(platform, device_code, name)
+
+    def __enter__(self):
+        self._token = _current_trace.set(self._trace)
+        return self._trace
+
+    def __exit__(self, *exc_info):
+        trace = self._trace
+        _current_trace.reset(self._token)
+        trace.stop()
+
+        _LOGGER.debug("%s (%s %s) set up in %.3fs: %s",
+                      trace.name, trace.platform, trace.device_code,
+                      trace.timings['total'],
+                      ", ".join("{} {:.3f}s".format(name, trace.timings[name])
+                                for name in SETUP_PHASES
+                                if name in trace.timings))
+
+        self._hass.data.setdefault(DOMAIN, {}).setdefault(
+            SETUP_TRACES, []).append(trace)
+
+
+def _round(seconds):
+    return round(seconds, 4)
+
+
+def get_setup_report(hass):
+    """Return the setup timings, with the device codes taking the most time.
+
+    Platforms set up their entities concurrently, so the wall time of the
+    SmartIR setup is reported along with the sum of the entity timings.
+    """
+    traces = hass.data.get(DOMAIN, {}).get(SETUP_TRACES, [])
+    if not traces:
+        return {'entities': []}
+
+    devices = {}
+    for trace in traces:
+        device = devices.setdefault(
+            '{} {}'.format(trace.platform, trace.device_code),
+            {'entities': 0, 'phases': {}})
+        device['entities'] += 1
+        for name, seconds in trace.timings.items():
+            device['phases'][name] = device['phases'].get(name, 0.0) + seconds
+
+    slowest = sorted(devices.items(), key=lambda item: item[1]['phases']['total'],
+                     reverse=True)[:SLOWEST_DEVICES]
+
+    return {
+        'wall_time': _round(max(trace.end for trace in traces) -
+                            min(trace.start for trace in traces)),
+        'total_time': _round(sum(trace.timings['total'] for trace in traces)),
+        'phases': {name: _round(sum(trace.timings.get(name, 0.0)
+                                    for trace in traces))
+                   for name in SETUP_PHASES},
+        'slowest_devices': {
+            name: {
+                'entities': device['entities'],
+                'phases': {phase_name: _round(seconds)
+                           for phase_name, seconds in device['phases'].items()},
+            }
+            for name, device in slowest
+        },
+        'entities': [
+            {
+                'name': trace.name,
+                'device': '{} {}'.format(trace.platform, trace.device_code),
+                'phases': {name: _round(seconds)
+                           for name, seconds in trace.timings.items()},
+            }
+            for trace in traces
+        ],
+    }
+
+
+def log_setup_report(hass):
+    """Log the setup time and the device codes taking the most of it."""
+    report = get_setup_report(hass)
+    if not report['entities']:
+        return
+
+    _LOGGER.debug("%d SmartIR entities set up in %.3fs (%.3fs in total), "
+                  "slowest devices: %s",
+                  len(report['entities']), report['wall_time'],
+                  report['total_time'],
+                  ", ".join("{} {:.3f}s".format(name, device['phases']['total'])
+                            for name, device in report['slowest_devices'].items()))
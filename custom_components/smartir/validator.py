@@ -0,0 +1,264 @@
+"""Validate SmartIR device files and build an index of them.
+
+Every device file is checked in a pool of processes for:
+
+    syntax     the file is valid JSON
+    keys       the fields the platform entities read are present, with
+               the expected types, and every command is a string or a
+               list of strings
+    coverage   a command exists for every state the entity can send: each
+               climate HVAC mode, fan mode, swing mode and temperature, each
+               fan direction and speed, and the light steps
+
+Syntax and key problems are errors, the entity can't be set up. Coverage
+problems are warnings, the entity fails when sending the missing states.
+
+The index maps every device code of every platform to its manufacturer,
+supported models, controller, commands encoding and file size, so that
+tools can list the device files without opening them.
+
+    python validator.py [--jobs N] [--index FILE] <device file or directory> [...]
+
+Directories are searched recursively, the platform of a device file is
+the name of its directory.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sys
+
+ENCODINGS = ['Base64', 'Hex', 'Pronto', 'Raw']
+
+COMMON_KEYS = {
+    'manufacturer': str,
+    'supportedModels': list,
+    'supportedController': str,
+    'commandsEncoding': str,
+    'commands': dict,
+}
+
+PLATFORM_KEYS = {
+    'climate': {
+        'minTemperature': (int, float),
+        'maxTemperature': (int, float),
+        'precision': (int, float),
+        'operationModes': list,
+        'fanModes': list,
+    },
+    'fan': {
+        'speed': list,
+    },
+    'light': {
+        'brightness': list,
+        'colorTemperature': list,
+    },
+    'media_player': {},
+}
+
+# The HVAC modes of Home Assistant, the climate entity ignores the other
+# operation modes of a device file
+HVAC_MODES = ['off', 'heat', 'cool', 'heat_cool', 'auto', 'dry', 'fan_only']
+
+MAX_MISSING_REPORTED = 5
+
+
+def _find_files(targets):
+    for target in targets:
+        if not os.path.isdir(target):
+            yield target
+            continue
+
+        for root, dirs, names in os.walk(target):
+            dirs.sort()
+            for name in sorted(names):
+                if name.endswith('.json'):
+                    yield os.path.join(root, name)
+
+
+def _iter_leaves(commands, path=()):
+    for key, value in commands.items():
+        if isinstance(value, dict):
+            yield from _iter_leaves(value, path + (key,))
+        else:
+            yield path + (key,), value
+
+
+def _is_command(value):
+    if isinstance(value, list):
+        return bool(value) and all(isinstance(item, str) for item in value)
+    return isinstance(value, str)
+
+
+def _missing(commands, *levels):
+    """Return the key paths of levels not found in commands."""
+    missing = []
+
+    def walk(node, path, levels):
+        if not levels:
+            return
+        for key in levels[0]:
+            if not isinstance(node, dict) or key not in node:
+                missing.append(path + (key,))
+            else:
+                walk(node[key], path + (key,), levels[1:])
+
+    walk(commands, (), levels)
+    return missing
+
+
+def _temperatures(device_data):
+    minimum = device_data['minTemperature']
+    precision = device_data['precision']
+    if precision <= 0:
+        return []
+
+    steps = int(round((device_data['maxTemperature'] - minimum) / precision))
+    return ['{0:g}'.format(round(minimum + step * precision, 1))
+            for step in range(steps + 1)]
+
+
+def _check_coverage(platform, device_data):
+    """Return the key paths of the commands missing for the platform."""
+    commands = device_data['commands']
+
+    if platform == 'climate':
+        modes = [mode for mode in device_data['operationModes']
+                 if mode in HVAC_MODES and mode != 'off']
+        levels = [modes, device_data['fanModes']]
+        if device_data.get('swingModes'):
+            levels.append(device_data['swingModes'])
+        levels.append(_temperatures(device_data))
+        return _missing(commands, ['off']) + _missing(commands, *levels)
+
+    if platform == 'fan':
+        if 'reverse' in commands and 'forward' in commands:
+            directions = ['reverse', 'forward']
+        else:
+            directions = ['default']
+        return (_missing(commands, ['off']) +
+                _missing(commands, directions, device_data['speed']))
+
+    if platform == 'light':
+        missing = []
+        if 'colder' in commands and 'warmer' in commands and \
+                not device_data['colorTemperature']:
+            missing.append(('colorTemperature',))
+        if 'brighten' in commands and 'dim' in commands and \
+                not device_data['brightness']:
+            missing.append(('brightness',))
+        return missing
+
+    return []
+
+
+def validate_file(path):
+    """Validate a device file.
+
+    Return the platform, device code, index entry (None if the file can't
+    be used), errors and warnings of the file.
+    """
+    platform = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    device_code = os.path.splitext(os.path.basename(path))[0]
+    errors = []
+    warnings = []
+
+    try:
+        with open(path, 'rb') as f:
+            content = f.read()
+        device_data = json.loads(content)
+    except (OSError, ValueError) as e:
+        return platform, device_code, None, [str(e)], warnings
+
+    if not isinstance(device_data, dict):
+        return platform, device_code, None, ["Not a JSON object"], warnings
+
+    if platform not in PLATFORM_KEYS:
+        warnings.append("Unknown platform {}, only the common fields "
+                        "are checked".format(platform))
+
+    expected = dict(COMMON_KEYS, **PLATFORM_KEYS.get(platform, {}))
+    for key, types in expected.items():
+        if key not in device_data:
+            errors.append("Missing {}".format(key))
+        elif not isinstance(device_data[key], types):
+            errors.append("{} has an invalid type".format(key))
+
+    if errors:
+        return platform, device_code, None, errors, warnings
+
+    if device_data['commandsEncoding'] not in ENCODINGS:
+        warnings.append("Unknown commands encoding {}".format(
+            device_data['commandsEncoding']))
+
+    for key_path, value in _iter_leaves(device_data['commands']):
+        if value is not None and not _is_command(value):
+            errors.append("Invalid command at {}".format('/'.join(key_path)))
+
+    missing = _check_coverage(platform, device_data)
+    if missing:
+        warnings.append("{} missing commands: {}{}".format(
+            len(missing),
+            ", ".join('/'.join(str(key) for key in key_path)
+                      for key_path in missing[:MAX_MISSING_REPORTED]),
+            ", ..." if len(missing) > MAX_MISSING_REPORTED else ""))
+
+    entry = {
+        'manufacturer': device_data['manufacturer'],
+        'models': device_data['supportedModels'],
+        'controller': device_data['supportedController'],
+        'encoding': device_data['commandsEncoding'],
+        'size': len(content),
+    }
+
+    return platform, device_code, entry, errors, warnings
+
+
+def main(argv):
+    """Validate the device files given on the command line."""
+    parser = argparse.ArgumentParser(
+        description="Validate SmartIR device files and build their index.")
+    parser.add_argument('targets', nargs='+', metavar='PATH',
+                        help="device file or directory")
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help="number of processes (default: one per CPU)")
+    parser.add_argument('--index', help="write the index to this JSON file")
+    parser.add_argument('--quiet', '-q', action='store_true',
+                        help="only report errors, not the missing commands")
+    args = parser.parse_args(argv)
+
+    paths = list(_find_files(args.targets))
+    index = {}
+    invalid = 0
+    incomplete = 0
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(validate_file, paths, chunksize=16)
+
+        for path, (platform, device_code, entry, errors, warnings) \
+                in zip(paths, results):
+            for error in errors:
+                print("{}: error: {}".format(path, error), file=sys.stderr)
+            if not args.quiet:
+                for warning in warnings:
+                    print("{}: warning: {}".format(path, warning),
+                          file=sys.stderr)
+
+            invalid += bool(errors)
+            incomplete += bool(warnings)
+
+            if entry is not None and not errors:
+                index.setdefault(platform, {})[device_code] = entry
+
+    print("{} device files checked, {} invalid, {} with warnings".format(
+        len(paths), invalid, incomplete), file=sys.stderr)
+
+    if args.index:
+        with open(args.index, 'w') as f:
+            json.dump(index, f, sort_keys=True, separators=(',', ':'))
+
+    return 1 if invalid else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))